@@ -0,0 +1,36 @@
+"""
+Queued logging for the API
+Request handlers only put log records on a queue; a background thread writes
+them to stdout, so a slow or contended terminal never stalls a request
+"""
+
+import atexit
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def setup_logging(level: str = None) -> None:
+    """Route the root logger through a queue drained by a listener thread (idempotent)"""
+    root = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    # Drain whatever is still queued when the process exits
+    atexit.register(listener.stop)
+
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+
+    # httpx logs every outbound request (Supabase, Paystack, Google) at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
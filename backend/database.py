@@ -4,9 +4,18 @@ Uses Supabase Python client for database operations
 """
 
 import os
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from functools import partial
 from pathlib import Path
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from typing import Optional, Dict, Any
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 
 # Load environment variables from backend/.env file
@@ -15,48 +24,167 @@ env_path = backend_dir / ".env"
 if env_path.exists():
     load_dotenv(env_path)
 
-from supabase import create_client, Client
+import httpx
+from cachetools import TTLCache
+from supabase import create_client, acreate_client, Client, AsyncClient
+from supabase.client import ClientOptions
+from supabase.lib.client_options import AsyncClientOptions
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
+
+log = logging.getLogger(__name__)
 
 # Supabase Configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")  # Use service_role key for backend
 
+# Parse PostgREST responses with orjson. supabase-py decodes every response
+# through httpx.Response.json, which uses the stdlib json module; orjson is
+# several times faster on row-heavy payloads such as message history.
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+if orjson is not None and not getattr(httpx.Response.json, "_orjson", False):
+    _stdlib_response_json = httpx.Response.json
+
+    def _orjson_response_json(self, **kwargs):
+        """httpx.Response.json backed by orjson, falling back for non-UTF-8 or custom kwargs"""
+        if kwargs:
+            return _stdlib_response_json(self, **kwargs)
+        try:
+            return orjson.loads(self.content)
+        except orjson.JSONDecodeError:
+            return _stdlib_response_json(self)
+
+    _orjson_response_json._orjson = True
+    httpx.Response.json = _orjson_response_json
+
+# Raise httpx's default connection limits so bursts reuse keep-alive
+# connections instead of opening new TLS connections per request.
+# Limits and http2 live on the transport because httpx ignores the
+# client-level arguments once a transport is supplied.
+_HTTP_LIMITS = httpx.Limits(max_connections=120, max_keepalive_connections=80, keepalive_expiry=60.0)
+_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+
 # Initialize Supabase client
 supabase: Optional[Client] = None
 
 if SUPABASE_URL and SUPABASE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    print("✅ Supabase client initialized")
+    _supabase_http = httpx.Client(
+        transport=httpx.HTTPTransport(retries=3, http2=True, limits=_HTTP_LIMITS),
+        timeout=_HTTP_TIMEOUT
+    )
+    supabase = create_client(
+        SUPABASE_URL,
+        SUPABASE_KEY,
+        options=ClientOptions(
+            postgrest_client_timeout=30,
+            storage_client_timeout=30,
+            httpx_client=_supabase_http
+        )
+    )
+    log.debug("Supabase client initialized")
 else:
-    print("⚠️ Supabase credentials not configured. Set SUPABASE_URL and SUPABASE_KEY environment variables.")
+    log.warning(
+        "Supabase credentials not configured. Set SUPABASE_URL and SUPABASE_KEY environment variables "
+        "(run `python database.py` for setup instructions)."
+    )
+
+
+# =============================================
+# ERRORS
+# =============================================
+
+class DatabaseError(Exception):
+    """Base class for errors raised by the database helpers"""
+
+
+class DatabaseNotConfiguredError(DatabaseError):
+    """Raised when Supabase credentials are not configured"""
+
+
+class UserCreationError(DatabaseError):
+    """Raised when a new user row could not be inserted"""
+
+
+# Failures a PostgREST call is expected to surface: errors reported by
+# PostgREST itself and transport errors from httpx. Anything else is a bug
+# and is left to propagate.
+_DB_ERRORS = (APIError, httpx.HTTPError)
+
+# PostgREST codes meaning "no row matched" (PGRST116 from .single(), 204 from
+# .maybe_single() on some supabase-py releases)
+_NO_ROWS_CODES = frozenset({"PGRST116", "204"})
+
+
+def _now_iso() -> str:
+    """Current UTC time as an ISO-8601 string"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _uuid7() -> uuid.UUID:
+    """
+    Time-ordered UUID (RFC 9562 version 7): a 48-bit Unix millisecond timestamp
+    followed by random bits, so new primary keys land at the right-hand edge of
+    the B-tree instead of on random index pages
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)  # version 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)  # RFC 4122 variant
+    return uuid.UUID(int=value)
+
+
+def new_id() -> str:
+    """New primary key for users, sessions and IP rows"""
+    return str(uuid.uuid7() if hasattr(uuid, "uuid7") else _uuid7())
 
 
 # =============================================
 # USER CLASS FOR COMPATIBILITY
 # =============================================
 
+def _parse_datetime(value) -> Optional[datetime]:
+    """Parse datetime from string or return as-is"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        return datetime.fromisoformat(value)
+    except (AttributeError, ValueError):
+        return None
+
+
+@dataclass(slots=True)
 class User:
     """User class for compatibility with existing code"""
-    def __init__(self, data: Dict[str, Any]):
-        self.id = data.get("id")
-        self.email = data.get("email")
-        self.username = data.get("username")
-        self.password = data.get("password")
-        self.auth_provider = data.get("auth_provider", "local")
-        self.created_at = self._parse_datetime(data.get("created_at"))
-        self.last_login = self._parse_datetime(data.get("last_login"))
-        self.is_active = data.get("is_active", True)
-    
-    def _parse_datetime(self, value):
-        """Parse datetime from string or return as-is"""
-        if value is None:
-            return None
-        if isinstance(value, datetime):
-            return value
-        try:
-            return datetime.fromisoformat(value.replace("Z", "+00:00"))
-        except:
-            return None
+    id: Optional[str] = None
+    email: Optional[str] = None
+    username: Optional[str] = None
+    password: Optional[str] = None
+    auth_provider: str = "local"
+    created_at: Optional[datetime] = None
+    last_login: Optional[datetime] = None
+    is_active: bool = True
+    
+    @classmethod
+    def from_row(cls, data: Dict[str, Any]) -> "User":
+        """Build a User from a users table row"""
+        get = data.get
+        return cls(
+            id=get("id"),
+            email=get("email"),
+            username=get("username"),
+            password=get("password"),
+            auth_provider=get("auth_provider", "local"),
+            created_at=_parse_datetime(get("created_at")),
+            last_login=_parse_datetime(get("last_login")),
+            is_active=get("is_active", True)
+        )
     
     def to_dict(self):
         """Convert user to dictionary"""
@@ -78,6 +206,8 @@ class User:
 
 class SupabaseSession:
     """Wrapper class for Supabase to maintain compatibility with existing code"""
+    __slots__ = ("client",)
+
     def __init__(self, client: Optional[Client]):
         self.client = client
     
@@ -86,18 +216,102 @@ class SupabaseSession:
         pass
 
 
+# Single shared session - the Supabase client is already a module global,
+# so there is nothing per-request to construct or tear down
+_SESSION_SINGLETON = SupabaseSession(supabase)
+
+
+def _table_handle(name: str):
+    """Bind client.table(name) once so helpers skip the per-call lookup"""
+    return partial(supabase.table, name) if supabase is not None else None
+
+
+_USERS_TBL = _table_handle("users")
+_IPS_TBL = _table_handle("user_ips")
+_SESSIONS_TBL = _table_handle("sessions")
+_MESSAGES_TBL = _table_handle("messages")
+
+
 def get_db():
     """Get database session - use as dependency in FastAPI"""
-    session = SupabaseSession(supabase)
-    try:
-        yield session
-    finally:
-        session.close()
+    yield _SESSION_SINGLETON
 
 
 def get_db_session() -> SupabaseSession:
-    """Get a new database session - use for direct calls"""
-    return SupabaseSession(supabase)
+    """Get the shared database session - use for direct calls"""
+    return _SESSION_SINGLETON
+
+
+# =============================================
+# COLUMN PROJECTIONS
+# =============================================
+
+# Explicit column lists so PostgREST only serializes what callers use
+USER_COLUMNS = "id,email,username,password,auth_provider,created_at,last_login,is_active"
+USER_IP_COLUMNS = "id,ip_address,user_agent,first_seen,last_seen"
+SESSION_LIST_COLUMNS = "session_id,title,last_activity,created_at,message_count"
+MESSAGE_COLUMNS = "role,content,message_index,timestamp"
+MESSAGE_LIST_COLUMNS = "role,message_index"
+
+
+# =============================================
+# USER LOOKUP CACHE
+# =============================================
+
+# Raw user rows keyed by id / hashed email. User rows change rarely, so a
+# short TTL saves a Supabase round-trip on every authenticated request.
+_USER_BY_ID_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_USER_BY_EMAIL_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_USER_CACHE_LOCK = threading.RLock()
+
+
+def _email_key(email: str) -> str:
+    """Fixed-width cache key for an email, so the cache doesn't hold raw addresses"""
+    return hashlib.blake2b(email.strip().lower().encode(), digest_size=16).hexdigest()
+
+
+def _cache_user_row(data: Dict[str, Any]) -> None:
+    """Store a raw user row in both lookup caches"""
+    with _USER_CACHE_LOCK:
+        if data.get("id"):
+            _USER_BY_ID_CACHE[data["id"]] = data
+        if data.get("email"):
+            _USER_BY_EMAIL_CACHE[_email_key(data["email"])] = data
+
+
+def invalidate_user_cache(user_id: Optional[str] = None, email: Optional[str] = None) -> None:
+    """Drop a user from both lookup caches after a mutation"""
+    with _USER_CACHE_LOCK:
+        if user_id:
+            _USER_BY_ID_CACHE.pop(user_id, None)
+        if email:
+            _USER_BY_EMAIL_CACHE.pop(_email_key(email), None)
+
+
+# Session owners keyed by session_id. A session's user_id never changes, so
+# only sessions that have an owner are cached; unowned/unknown ids are
+# re-checked since an authenticated user may still create them.
+_SESSION_OWNER_CACHE: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+_SESSION_OWNER_LOCK = threading.RLock()
+
+
+def _cache_session_owner(session_id: str, user_id: Optional[str]) -> None:
+    """Remember the owner of a session"""
+    if session_id and user_id:
+        with _SESSION_OWNER_LOCK:
+            _SESSION_OWNER_CACHE[session_id] = user_id
+
+
+def _cached_session_owner(session_id: str) -> Optional[str]:
+    """Look up a cached session owner"""
+    with _SESSION_OWNER_LOCK:
+        return _SESSION_OWNER_CACHE.get(session_id)
+
+
+def invalidate_session_owner(session_id: str) -> None:
+    """Forget the cached owner of a session"""
+    with _SESSION_OWNER_LOCK:
+        _SESSION_OWNER_CACHE.pop(session_id, None)
 
 
 # =============================================
@@ -109,13 +323,24 @@ def get_user_by_id(db: SupabaseSession, user_id: str) -> Optional[User]:
     if not db.client:
         return None
     
+    with _USER_CACHE_LOCK:
+        cached = _USER_BY_ID_CACHE.get(user_id)
+    if cached is not None:
+        return User.from_row(cached)
+    
     try:
-        response = db.client.table("users").select("*").eq("id", user_id).single().execute()
-        if response.data:
-            return User(response.data)
+        response = _USERS_TBL().select(USER_COLUMNS).eq("id", user_id).maybe_single().execute()
+        if response and response.data:
+            _cache_user_row(response.data)
+            return User.from_row(response.data)
         return None
-    except Exception as e:
-        print(f"Error getting user by ID: {e}")
+    except APIError as e:
+        if e.code in _NO_ROWS_CODES:
+            return None
+        log.exception("Error getting user by ID")
+        return None
+    except httpx.HTTPError:
+        log.exception("Error getting user by ID")
         return None
 
 
@@ -124,16 +349,24 @@ def get_user_by_email(db: SupabaseSession, email: str) -> Optional[User]:
     if not db.client:
         return None
     
+    with _USER_CACHE_LOCK:
+        cached = _USER_BY_EMAIL_CACHE.get(_email_key(email))
+    if cached is not None:
+        return User.from_row(cached)
+    
     try:
-        response = db.client.table("users").select("*").eq("email", email.lower()).single().execute()
-        if response.data:
-            return User(response.data)
+        response = _USERS_TBL().select(USER_COLUMNS).eq("email", email.lower()).maybe_single().execute()
+        if response and response.data:
+            _cache_user_row(response.data)
+            return User.from_row(response.data)
         return None
-    except Exception as e:
-        # User not found is not an error
-        if "0 rows" in str(e) or "multiple" not in str(e).lower():
+    except APIError as e:
+        if e.code in _NO_ROWS_CODES:
             return None
-        print(f"Error getting user by email: {e}")
+        log.exception("Error getting user by email")
+        return None
+    except httpx.HTTPError:
+        log.exception("Error getting user by email")
         return None
 
 
@@ -147,24 +380,28 @@ def create_user(
 ) -> User:
     """Create a new user"""
     if not db.client:
-        raise Exception("Supabase client not initialized")
+        raise DatabaseNotConfiguredError("Supabase client not initialized")
     
+    # A new account is signed straight in, so last_login is set on insert
+    now = _now_iso()
     user_data = {
         "id": user_id,
         "email": email.lower(),
         "username": username,
         "password": password,
         "auth_provider": auth_provider,
-        "created_at": datetime.utcnow().isoformat(),
+        "created_at": now,
+        "last_login": now,
         "is_active": True
     }
     
-    response = db.client.table("users").insert(user_data).execute()
+    response = _USERS_TBL().insert(user_data).execute()
+    invalidate_user_cache(user_id, email)
     
     if response.data:
-        return User(response.data[0])
+        return User.from_row(response.data[0])
     else:
-        raise Exception("Failed to create user")
+        raise UserCreationError("Failed to create user")
 
 
 def update_user_last_login(db: SupabaseSession, user: User) -> User:
@@ -173,19 +410,37 @@ def update_user_last_login(db: SupabaseSession, user: User) -> User:
         return user
     
     try:
-        now = datetime.utcnow().isoformat()
-        response = db.client.table("users").update(
-            {"last_login": now}
+        now = _now_iso()
+        _USERS_TBL().update(
+            {"last_login": now}, returning=ReturnMethod.minimal
         ).eq("id", user.id).execute()
+        invalidate_user_cache(user.id, user.email)
         
-        if response.data:
-            return User(response.data[0])
+        # Only last_login changed, so patch the local object instead of
+        # asking PostgREST to send the whole row back
+        user.last_login = _parse_datetime(now)
         return user
-    except Exception as e:
-        print(f"Error updating last login: {e}")
+    except _DB_ERRORS:
+        log.exception("Error updating last login")
         return user
 
 
+def update_user_password(db: SupabaseSession, user: User, hashed_password: str) -> bool:
+    """Replace a user's stored password hash"""
+    if not db.client:
+        return False
+    
+    try:
+        _USERS_TBL().update(
+            {"password": hashed_password}, returning=ReturnMethod.minimal
+        ).eq("id", user.id).execute()
+        invalidate_user_cache(user.id, user.email)
+        return True
+    except _DB_ERRORS:
+        log.exception("Error updating password")
+        return False
+
+
 # =============================================
 # IP TRACKING & SESSION MANAGEMENT
 # =============================================
@@ -196,10 +451,10 @@ def get_user_ips(db: SupabaseSession, user_id: str) -> list:
         return []
     
     try:
-        response = db.client.table("user_ips").select("*").eq("user_id", user_id).execute()
+        response = _IPS_TBL().select(USER_IP_COLUMNS).eq("user_id", user_id).execute()
         return response.data or []
-    except Exception as e:
-        print(f"Error getting user IPs: {e}")
+    except _DB_ERRORS:
+        log.exception("Error getting user IPs")
         return []
 
 
@@ -209,10 +464,12 @@ def is_new_ip_for_user(db: SupabaseSession, user_id: str, ip_address: str) -> bo
         return True
     
     try:
-        response = db.client.table("user_ips").select("id").eq("user_id", user_id).eq("ip_address", ip_address).execute()
-        return not response.data or len(response.data) == 0
-    except Exception as e:
-        print(f"Error checking IP: {e}")
+        # Existence check only: served from the UNIQUE(user_id, ip_address)
+        # index and stops at the first match
+        response = _IPS_TBL().select("id").eq("user_id", user_id).eq("ip_address", ip_address).limit(1).execute()
+        return not response.data
+    except _DB_ERRORS:
+        log.exception("Error checking IP")
         return True
 
 
@@ -221,26 +478,25 @@ def register_user_ip(db: SupabaseSession, user_id: str, ip_address: str, user_ag
     if not db.client:
         return None
     
-    import uuid
-    
     try:
         # Create IP record
+        now = _now_iso()
         ip_data = {
-            "id": str(uuid.uuid4()),
+            "id": new_id(),
             "user_id": user_id,
             "ip_address": ip_address,
             "user_agent": user_agent,
-            "first_seen": datetime.utcnow().isoformat(),
-            "last_seen": datetime.utcnow().isoformat()
+            "first_seen": now,
+            "last_seen": now
         }
         
-        response = db.client.table("user_ips").insert(ip_data).execute()
+        response = _IPS_TBL().insert(ip_data).execute()
         
         if response.data:
             return response.data[0]
         return None
-    except Exception as e:
-        print(f"Error registering IP: {e}")
+    except _DB_ERRORS:
+        log.exception("Error registering IP")
         return None
 
 
@@ -250,11 +506,43 @@ def update_ip_last_seen(db: SupabaseSession, user_id: str, ip_address: str) -> N
         return
     
     try:
-        db.client.table("user_ips").update(
-            {"last_seen": datetime.utcnow().isoformat()}
+        _IPS_TBL().update(
+            {"last_seen": _now_iso()}, returning=ReturnMethod.minimal
         ).eq("user_id", user_id).eq("ip_address", ip_address).execute()
-    except Exception as e:
-        print(f"Error updating IP last seen: {e}")
+    except _DB_ERRORS:
+        log.exception("Error updating IP last seen")
+
+
+def track_user_ip(db: SupabaseSession, user_id: str, ip_address: str, user_agent: str = None) -> bool:
+    """
+    Register or refresh an IP address for a user in a single UPSERT.
+    Returns True if the IP is new for this user.
+    """
+    if not db.client:
+        return True
+    
+    try:
+        ip_data = {
+            "user_id": user_id,
+            "ip_address": ip_address,
+            "last_seen": _now_iso()
+        }
+        if user_agent:
+            ip_data["user_agent"] = user_agent
+        
+        response = _IPS_TBL().upsert(
+            ip_data, on_conflict="user_id,ip_address", ignore_duplicates=False
+        ).execute()
+        
+        # The set_user_ip_first_seen trigger stamps first_seen from last_seen on
+        # insert only, so the two match exactly for a freshly registered IP
+        if response.data:
+            row = response.data[0]
+            return row.get("first_seen") == row.get("last_seen")
+        return True
+    except _DB_ERRORS:
+        log.exception("Error tracking IP")
+        return True
 
 
 def create_user_session(db: SupabaseSession, user_id: str, ip_address: str = None, session_id: str = None) -> str:
@@ -262,28 +550,28 @@ def create_user_session(db: SupabaseSession, user_id: str, ip_address: str = Non
     if not db.client:
         return None
     
-    import uuid
-    
     try:
         # Use provided session_id or generate a new one
-        final_session_id = session_id or str(uuid.uuid4())
+        final_session_id = session_id or new_id()
+        now = _now_iso()
         session_data = {
             "session_id": final_session_id,
             "user_id": user_id,
             "ip_address": ip_address,
-            "created_at": datetime.utcnow().isoformat(),
-            "last_activity": datetime.utcnow().isoformat(),
+            "created_at": now,
+            "last_activity": now,
             "title": "New Conversation"
         }
         
-        response = db.client.table("sessions").insert(session_data).execute()
+        response = _SESSIONS_TBL().insert(session_data).execute()
         
         if response.data:
-            print(f"📝 Created new session {final_session_id} for user {user_id} from IP {ip_address}")
+            _cache_session_owner(final_session_id, user_id)
+            log.info("Created session %s for user %s from IP %s", final_session_id, user_id, ip_address)
             return final_session_id
         return None
-    except Exception as e:
-        print(f"Error creating session: {e}")
+    except _DB_ERRORS:
+        log.exception("Error creating session")
         return None
 
 
@@ -293,10 +581,10 @@ def get_user_sessions(db: SupabaseSession, user_id: str) -> list:
         return []
     
     try:
-        response = db.client.table("sessions").select("*").eq("user_id", user_id).order("last_activity", desc=True).execute()
+        response = _SESSIONS_TBL().select(SESSION_LIST_COLUMNS).eq("user_id", user_id).order("last_activity", desc=True).execute()
         return response.data or []
-    except Exception as e:
-        print(f"Error getting user sessions: {e}")
+    except _DB_ERRORS:
+        log.exception("Error getting user sessions")
         return []
 
 
@@ -305,13 +593,19 @@ def get_session_owner(db: SupabaseSession, session_id: str) -> Optional[str]:
     if not db.client:
         return None
     
+    owner = _cached_session_owner(session_id)
+    if owner is not None:
+        return owner
+    
     try:
-        response = db.client.table("sessions").select("user_id").eq("session_id", session_id).execute()
+        response = _SESSIONS_TBL().select("user_id").eq("session_id", session_id).execute()
         if response.data and len(response.data) > 0:
-            return response.data[0].get("user_id")
+            owner = response.data[0].get("user_id")
+            _cache_session_owner(session_id, owner)
+            return owner
         return None
-    except Exception as e:
-        print(f"Error getting session owner: {e}")
+    except _DB_ERRORS:
+        log.exception("Error getting session owner")
         return None
 
 
@@ -320,12 +614,7 @@ def verify_session_ownership(db: SupabaseSession, session_id: str, user_id: str)
     if not db.client:
         return False
     
-    try:
-        response = db.client.table("sessions").select("user_id").eq("session_id", session_id).eq("user_id", user_id).execute()
-        return response.data and len(response.data) > 0
-    except Exception as e:
-        print(f"Error verifying session ownership: {e}")
-        return False
+    return user_id is not None and get_session_owner(db, session_id) == user_id
 
 
 def delete_user_session(db: SupabaseSession, session_id: str, user_id: str) -> bool:
@@ -334,10 +623,11 @@ def delete_user_session(db: SupabaseSession, session_id: str, user_id: str) -> b
         return False
     
     try:
-        response = db.client.table("sessions").delete().eq("session_id", session_id).eq("user_id", user_id).execute()
+        response = _SESSIONS_TBL().delete().eq("session_id", session_id).eq("user_id", user_id).execute()
+        invalidate_session_owner(session_id)
         return response.data and len(response.data) > 0
-    except Exception as e:
-        print(f"Error deleting session: {e}")
+    except _DB_ERRORS:
+        log.exception("Error deleting session")
         return False
 
 
@@ -347,30 +637,221 @@ def update_session_title(db: SupabaseSession, session_id: str, title: str) -> bo
         return False
     
     try:
-        db.client.table("sessions").update(
-            {"title": title, "last_activity": datetime.utcnow().isoformat()}
+        _SESSIONS_TBL().update(
+            {"title": title, "last_activity": _now_iso()}, returning=ReturnMethod.minimal
         ).eq("session_id", session_id).execute()
         return True
-    except Exception as e:
-        print(f"Error updating session title: {e}")
+    except _DB_ERRORS:
+        log.exception("Error updating session title")
         return False
 
 
+# Pending session activity updates, coalesced per session and written out by
+# run_session_activity_flusher at most once per flush interval
+_ACTIVITY_PENDING: Dict[str, Dict[str, Any]] = {}
+_ACTIVITY_LOCK = threading.Lock()
+_ACTIVITY_FLUSH_INTERVAL = 2.0
+_ACTIVITY_MAX_PENDING = 1000
+
+
 def update_session_activity(db: SupabaseSession, session_id: str, message_count: int = None) -> bool:
-    """Update the last activity timestamp and optionally message count for a session"""
+    """
+    Record the last activity timestamp and optionally message count for a session.
+    The write is buffered: the latest timestamp and the highest message count
+    win, and the buffer is flushed in the background.
+    """
     if not db.client:
         return False
     
-    try:
-        update_data = {"last_activity": datetime.utcnow().isoformat()}
+    if _buffer_session_activity(session_id, message_count):
+        flush_session_activity(db)
+    return True
+
+
+def _buffer_session_activity(session_id: str, message_count: Optional[int]) -> bool:
+    """Add an activity update to the buffer. Returns True once the buffer is full."""
+    with _ACTIVITY_LOCK:
+        pending = _ACTIVITY_PENDING.setdefault(session_id, {})
+        pending["last_activity"] = _now_iso()
         if message_count is not None:
-            update_data["message_count"] = message_count
-        
-        db.client.table("sessions").update(update_data).eq("session_id", session_id).execute()
-        return True
-    except Exception as e:
-        print(f"Error updating session activity: {e}")
-        return False
+            pending["message_count"] = max(message_count, pending.get("message_count", message_count))
+        return len(_ACTIVITY_PENDING) >= _ACTIVITY_MAX_PENDING
+
+
+def queue_session_activity(session_id: str, message_count: int = None) -> None:
+    """
+    Buffer a session activity update from async code. Never touches the
+    database itself; run_session_activity_flusher writes the buffer out.
+    """
+    if _SESSION_SINGLETON.client:
+        _buffer_session_activity(session_id, message_count)
+
+
+def flush_session_activity(db: SupabaseSession) -> int:
+    """Write all buffered session activity updates. Returns the number flushed."""
+    with _ACTIVITY_LOCK:
+        pending = dict(_ACTIVITY_PENDING)
+        _ACTIVITY_PENDING.clear()
+    
+    if not db.client:
+        return 0
+    
+    # Plain UPDATEs rather than an upsert so guest session ids that were never
+    # stored don't get inserted as ownerless rows
+    for session_id, update_data in pending.items():
+        try:
+            _SESSIONS_TBL().update(
+                update_data, returning=ReturnMethod.minimal
+            ).eq("session_id", session_id).execute()
+        except _DB_ERRORS:
+            log.exception("Error updating session activity")
+    return len(pending)
+
+
+async def run_session_activity_flusher(interval: float = _ACTIVITY_FLUSH_INTERVAL) -> None:
+    """Background task that periodically flushes buffered session activity"""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            if _ACTIVITY_PENDING:
+                await asyncio.to_thread(flush_session_activity, _SESSION_SINGLETON)
+    finally:
+        # Flush whatever is left on shutdown
+        flush_session_activity(_SESSION_SINGLETON)
+
+
+# =============================================
+# LOGIN
+# =============================================
+
+def _handle_login_params(user: User, ip_address: str, user_agent: str, session_id: str) -> Dict[str, Any]:
+    """Arguments for the handle_login stored function"""
+    return {
+        "p_user_id": user.id,
+        "p_ip": ip_address,
+        "p_ua": user_agent,
+        # Generated here so RPC rows get the same time-ordered keys as the fallback
+        "p_session_id": session_id or new_id(),
+        "p_ip_id": new_id()
+    }
+
+
+def _handle_login_result(data: Optional[Dict[str, Any]], user: User, ip_address: str) -> Dict[str, Any]:
+    """Turn the handle_login stored function's JSON into a login result"""
+    invalidate_user_cache(user.id, user.email)
+    data = data or {}
+    session_id = data.get("session_id")
+    if session_id:
+        _cache_session_owner(session_id, user.id)
+        log.info("Created session %s for user %s from IP %s", session_id, user.id, ip_address)
+    return {
+        "user": User.from_row(data["user"]) if data.get("user") else user,
+        "is_new_ip": bool(data.get("is_new_ip")),
+        "session_id": session_id
+    }
+
+
+def handle_login(
+    db: SupabaseSession,
+    user: User,
+    ip_address: str,
+    user_agent: str = None,
+    session_id: str = None
+) -> Dict[str, Any]:
+    """
+    Run all post-authentication bookkeeping in one round-trip via the
+    handle_login stored function: update last_login, track the IP and
+    create a session if the IP is new for the user.
+
+    Returns a dict with the refreshed "user", "is_new_ip" and "session_id"
+    (None unless a session was created). Falls back to the step-by-step
+    helpers if the stored function is unavailable.
+    """
+    if not db.client:
+        return {"user": user, "is_new_ip": True, "session_id": None}
+    
+    try:
+        response = db.client.rpc(
+            "handle_login", _handle_login_params(user, ip_address, user_agent, session_id)
+        ).execute()
+        return _handle_login_result(response.data, user, ip_address)
+    except _DB_ERRORS as e:
+        log.warning("handle_login RPC failed, falling back to separate queries: %s", e)
+    
+    user = update_user_last_login(db, user)
+    is_new_ip = track_user_ip(db, user.id, ip_address, user_agent)
+    new_session_id = create_user_session(db, user.id, ip_address, session_id) if is_new_ip else None
+    return {"user": user, "is_new_ip": is_new_ip, "session_id": new_session_id}
+
+
+def _handle_signup_params(
+    user_id: str,
+    email: str,
+    username: str,
+    password: Optional[str],
+    ip_address: str,
+    user_agent: str,
+    auth_provider: str
+) -> Dict[str, Any]:
+    """Arguments for the handle_signup stored function"""
+    return {
+        "p_user_id": user_id,
+        "p_email": email.lower(),
+        "p_username": username,
+        "p_password": password,
+        "p_ip": ip_address,
+        "p_ua": user_agent,
+        "p_auth_provider": auth_provider,
+        # Generated here so RPC rows get the same time-ordered keys as the fallback
+        "p_session_id": new_id(),
+        "p_ip_id": new_id()
+    }
+
+
+def _handle_signup_result(data: Optional[Dict[str, Any]], user_id: str, email: str, ip_address: str) -> Dict[str, Any]:
+    """Turn the handle_signup stored function's JSON into a signup result"""
+    invalidate_user_cache(user_id, email)
+    data = data or {}
+    if not data.get("user"):
+        raise UserCreationError("Failed to create user")
+    session_id = data.get("session_id")
+    if session_id:
+        _cache_session_owner(session_id, user_id)
+        log.info("Created session %s for user %s from IP %s", session_id, user_id, ip_address)
+    return {"user": User.from_row(data["user"]), "session_id": session_id}
+
+
+def handle_signup(
+    db: SupabaseSession,
+    user_id: str,
+    email: str,
+    username: str,
+    password: Optional[str],
+    ip_address: str,
+    user_agent: str = None,
+    auth_provider: str = "local"
+) -> Dict[str, Any]:
+    """
+    Create a user, register their IP and open their first session in one
+    round-trip via the handle_signup stored function.
+
+    Returns a dict with the new "user" and "session_id". Falls back to the
+    step-by-step helpers if the stored function is unavailable.
+    """
+    if not db.client:
+        raise DatabaseNotConfiguredError("Supabase client not initialized")
+    
+    params = _handle_signup_params(user_id, email, username, password, ip_address, user_agent, auth_provider)
+    try:
+        response = db.client.rpc("handle_signup", params).execute()
+        return _handle_signup_result(response.data, user_id, email, ip_address)
+    except _DB_ERRORS as e:
+        log.warning("handle_signup RPC failed, falling back to separate queries: %s", e)
+    
+    user = create_user(db, user_id, email, username, password, auth_provider)
+    track_user_ip(db, user_id, ip_address, user_agent)
+    new_session_id = create_user_session(db, user_id, ip_address)
+    return {"user": user, "session_id": new_session_id}
 
 
 # =============================================
@@ -385,7 +866,7 @@ CREATE TABLE IF NOT EXISTS users (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     email VARCHAR(255) UNIQUE NOT NULL,
     username VARCHAR(30) NOT NULL,
-    password VARCHAR(64),
+    password VARCHAR(255),
     auth_provider VARCHAR(20) DEFAULT 'local',
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     last_login TIMESTAMP WITH TIME ZONE,
@@ -406,10 +887,24 @@ CREATE TABLE IF NOT EXISTS user_ips (
     UNIQUE(user_id, ip_address)
 );
 
--- Create index for IP lookups
-CREATE INDEX IF NOT EXISTS idx_user_ips_user ON user_ips(user_id);
+-- Create index for IP lookups. The UNIQUE(user_id, ip_address) constraint
+-- already indexes lookups by user and by (user, IP), so a separate user_id
+-- index would only add write cost to every login upsert
+DROP INDEX IF EXISTS idx_user_ips_user;
 CREATE INDEX IF NOT EXISTS idx_user_ips_ip ON user_ips(ip_address);
 
+-- Stamp first_seen from last_seen on insert so an upsert can tell new IPs apart
+CREATE OR REPLACE FUNCTION set_user_ip_first_seen() RETURNS trigger AS $$
+BEGIN
+    NEW.first_seen := NEW.last_seen;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_user_ips_first_seen ON user_ips;
+CREATE TRIGGER trg_user_ips_first_seen BEFORE INSERT ON user_ips
+    FOR EACH ROW EXECUTE FUNCTION set_user_ip_first_seen();
+
 -- Create sessions table for chat sessions
 CREATE TABLE IF NOT EXISTS sessions (
     session_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -424,10 +919,100 @@ CREATE TABLE IF NOT EXISTS sessions (
 -- Create index for session lookups
 CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id);
 
+-- Create messages table for persisted chat history
+CREATE TABLE IF NOT EXISTS messages (
+    id BIGSERIAL PRIMARY KEY,
+    session_id UUID NOT NULL REFERENCES sessions(session_id) ON DELETE CASCADE,
+    user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+    role VARCHAR(20) NOT NULL,
+    content TEXT NOT NULL,
+    message_index INTEGER NOT NULL,
+    timestamp TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Composite index so history reads are an already-sorted index range scan
+CREATE INDEX IF NOT EXISTS idx_messages_session_index ON messages(session_id, message_index);
+
+-- Post-login bookkeeping in one call: update last_login, upsert the IP and
+-- create a session when the IP is new for the user. The API passes the new
+-- row ids (time-ordered UUIDv7); the random defaults only cover other callers.
+DROP FUNCTION IF EXISTS handle_login(UUID, TEXT, TEXT, UUID);
+CREATE OR REPLACE FUNCTION handle_login(
+    p_user_id UUID,
+    p_ip TEXT,
+    p_ua TEXT DEFAULT NULL,
+    p_session_id UUID DEFAULT NULL,
+    p_ip_id UUID DEFAULT NULL
+) RETURNS JSONB AS $$
+DECLARE
+    v_user users;
+    v_is_new_ip BOOLEAN;
+    v_session_id UUID;
+BEGIN
+    UPDATE users SET last_login = NOW() WHERE id = p_user_id RETURNING * INTO v_user;
+
+    INSERT INTO user_ips (id, user_id, ip_address, user_agent, last_seen)
+    VALUES (COALESCE(p_ip_id, gen_random_uuid()), p_user_id, p_ip, p_ua, NOW())
+    ON CONFLICT (user_id, ip_address) DO UPDATE
+        SET last_seen = EXCLUDED.last_seen,
+            user_agent = COALESCE(EXCLUDED.user_agent, user_ips.user_agent)
+    RETURNING (xmax = 0) INTO v_is_new_ip;
+
+    IF v_is_new_ip THEN
+        INSERT INTO sessions (session_id, user_id, ip_address, title)
+        VALUES (COALESCE(p_session_id, gen_random_uuid()), p_user_id, p_ip, 'New Conversation')
+        RETURNING session_id INTO v_session_id;
+    END IF;
+
+    RETURN jsonb_build_object(
+        'user', to_jsonb(v_user),
+        'is_new_ip', v_is_new_ip,
+        'session_id', v_session_id
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Signup in one call: insert the user, register their IP and open their
+-- first session, with row ids passed in by the API like handle_login
+DROP FUNCTION IF EXISTS handle_signup(UUID, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT);
+CREATE OR REPLACE FUNCTION handle_signup(
+    p_user_id UUID,
+    p_email TEXT,
+    p_username TEXT,
+    p_password TEXT,
+    p_ip TEXT,
+    p_ua TEXT DEFAULT NULL,
+    p_auth_provider TEXT DEFAULT 'local',
+    p_session_id UUID DEFAULT NULL,
+    p_ip_id UUID DEFAULT NULL
+) RETURNS JSONB AS $$
+DECLARE
+    v_user users;
+    v_session_id UUID;
+BEGIN
+    INSERT INTO users (id, email, username, password, auth_provider, created_at, last_login, is_active)
+    VALUES (p_user_id, lower(p_email), p_username, p_password, p_auth_provider, NOW(), NOW(), TRUE)
+    RETURNING * INTO v_user;
+
+    INSERT INTO user_ips (id, user_id, ip_address, user_agent, last_seen)
+    VALUES (COALESCE(p_ip_id, gen_random_uuid()), p_user_id, p_ip, p_ua, NOW());
+
+    INSERT INTO sessions (session_id, user_id, ip_address, title)
+    VALUES (COALESCE(p_session_id, gen_random_uuid()), p_user_id, p_ip, 'New Conversation')
+    RETURNING session_id INTO v_session_id;
+
+    RETURN jsonb_build_object(
+        'user', to_jsonb(v_user),
+        'session_id', v_session_id
+    );
+END;
+$$ LANGUAGE plpgsql;
+
 -- Enable Row Level Security (optional but recommended)
 ALTER TABLE users ENABLE ROW LEVEL SECURITY;
 ALTER TABLE user_ips ENABLE ROW LEVEL SECURITY;
 ALTER TABLE sessions ENABLE ROW LEVEL SECURITY;
+ALTER TABLE messages ENABLE ROW LEVEL SECURITY;
 
 -- Create policy to allow service role full access
 CREATE POLICY "Service role has full access to users" ON users
@@ -438,6 +1023,9 @@ CREATE POLICY "Service role has full access to user_ips" ON user_ips
 
 CREATE POLICY "Service role has full access to sessions" ON sessions
     FOR ALL USING (true) WITH CHECK (true);
+
+CREATE POLICY "Service role has full access to messages" ON messages
+    FOR ALL USING (true) WITH CHECK (true);
 """
 
 def print_setup_instructions():
@@ -464,43 +1052,547 @@ def print_setup_instructions():
     print(SUPABASE_TABLE_SQL)
 
 
-# Print setup instructions if Supabase is not configured
-if not supabase:
-    print_setup_instructions()
-
 
 # =============================================
 # MESSAGE PERSISTENCE FUNCTIONS
 # =============================================
+def save_messages(db: 'SupabaseSession', messages: list, start_index: int = None):
+    """
+    Save several chat messages to the Supabase 'messages' table in one insert.
+    If start_index is given, message_index is assigned sequentially from it.
+    Messages without a timestamp share a single one.
+    """
+    if not messages:
+        return None
+    timestamp = _now_iso()
+    for offset, message in enumerate(messages):
+        if start_index is not None:
+            message["message_index"] = start_index + offset
+        message.setdefault("timestamp", timestamp)
+    response = _MESSAGES_TBL().insert(messages).execute()
+    return response
+
+
 def save_message(db: 'SupabaseSession', session_id: str, user_id: str, role: str, content: str, message_index: int, timestamp: str = None):
     """
     Save a chat message to the Supabase 'messages' table.
     """
-    if timestamp is None:
-        from datetime import datetime
-        timestamp = datetime.utcnow().isoformat()
     data = {
         "session_id": session_id,
         "user_id": user_id,
         "role": role,
         "content": content,
-        "message_index": message_index,
-        "timestamp": timestamp
+        "message_index": message_index
     }
-    response = db.client.table("messages").insert(data).execute()
-    return response
-
-
-def get_messages_for_session(db: 'SupabaseSession', session_id: str):
+    if timestamp is not None:
+        data["timestamp"] = timestamp
+    return save_messages(db, [data])
+
+
+def get_messages_for_session(
+    db: 'SupabaseSession',
+    session_id: str,
+    after_index: int = -1,
+    limit: int = 200,
+    fields: str = MESSAGE_COLUMNS
+):
     """
-    Retrieve all messages for a given session_id, ordered by message_index.
+    Retrieve a page of messages for a given session_id, ordered by message_index.
+    Uses keyset pagination: pass the last message_index seen as after_index to
+    fetch the next page.
+    Pass fields=MESSAGE_LIST_COLUMNS for listing views that don't need content.
     Returns a list of message dicts.
     """
-    response = db.client.table("messages") \
-        .select("*") \
+    response = _MESSAGES_TBL() \
+        .select(fields) \
         .eq("session_id", session_id) \
+        .gt("message_index", after_index) \
         .order("message_index", desc=False) \
+        .limit(limit) \
         .execute()
     if hasattr(response, 'data'):
         return response.data
     return []
+
+
+# =============================================
+# ASYNCPG READ PATHS
+# =============================================
+# Read-heavy helpers talk to Postgres directly over asyncpg's binary protocol
+# instead of the PostgREST HTTPS gateway. Set SUPABASE_DB_URL to the pooler
+# connection string (session mode, port 5432) to enable them; otherwise each
+# helper falls back to its PostgREST counterpart above.
+
+try:
+    import asyncpg
+    _PG_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError)
+except ImportError:  # pragma: no cover - optional dependency
+    asyncpg = None
+    _PG_ERRORS = (OSError,)
+
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL", "")
+
+_PG_POOL = None
+
+
+def _is_pooled_dsn(dsn: str) -> bool:
+    """
+    Whether the DSN goes through Supavisor/pgbouncer rather than straight to
+    Postgres: the transaction pooler listens on 6543 and the shared pooler
+    hosts live under pooler.supabase.com.
+    """
+    parsed = urlparse(dsn)
+    return parsed.port == 6543 or (parsed.hostname or "").endswith("pooler.supabase.com")
+
+
+def _pg_pool_options(dsn: str) -> Dict[str, Any]:
+    """asyncpg pool settings for the given DSN"""
+    options: Dict[str, Any] = {
+        "min_size": 10,
+        "max_size": 50,
+        "max_inactive_connection_lifetime": 300
+    }
+    if _is_pooled_dsn(dsn):
+        # A pooler hands each statement to whichever backend is free, so
+        # asyncpg's named prepared statements vanish between calls
+        # ("prepared statement __asyncpg_stmt_X__ does not exist")
+        options["statement_cache_size"] = 0
+        options["max_cached_statement_lifetime"] = 0
+    return options
+
+
+async def init_pg_pool():
+    """Create the asyncpg connection pool (call once at app startup)"""
+    global _PG_POOL
+    if _PG_POOL is not None or not SUPABASE_DB_URL or asyncpg is None:
+        return _PG_POOL
+    
+    try:
+        _PG_POOL = await asyncpg.create_pool(dsn=SUPABASE_DB_URL, **_pg_pool_options(SUPABASE_DB_URL))
+        log.info("asyncpg pool initialized")
+    except (*_PG_ERRORS, asyncio.TimeoutError):
+        # Only connection failures fall back; bad options or code errors surface
+        log.exception("Could not create asyncpg pool, using PostgREST for reads")
+        _PG_POOL = None
+    return _PG_POOL
+
+
+async def close_pg_pool() -> None:
+    """Close the asyncpg connection pool (call once at app shutdown)"""
+    global _PG_POOL
+    if _PG_POOL is not None:
+        await _PG_POOL.close()
+        _PG_POOL = None
+
+
+def _record_value(value: Any) -> Any:
+    """Match PostgREST's JSON types: UUIDs and timestamps come back as strings"""
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _record_to_dict(record) -> Dict[str, Any]:
+    """Convert an asyncpg Record to a plain dict with string UUIDs and ISO timestamps"""
+    return {key: _record_value(value) for key, value in record.items()}
+
+
+# Auth-path lookups are built once so every call sends identical SQL text and
+# hits asyncpg's per-connection prepared statement cache
+_SELECT_USER_BY_ID = f"SELECT {USER_COLUMNS} FROM users WHERE id = $1"
+_SELECT_USER_BY_EMAIL = f"SELECT {USER_COLUMNS} FROM users WHERE email = $1"
+
+
+def _user_from_record(record) -> Optional[User]:
+    """Map a users row from asyncpg to a User, caching it for later lookups"""
+    if record is None:
+        return None
+    data = _record_to_dict(record)
+    _cache_user_row(data)
+    return User.from_row(data)
+
+
+async def get_user_by_id_async(user_id: str) -> Optional[User]:
+    """Get user by ID over asyncpg"""
+    with _USER_CACHE_LOCK:
+        cached = _USER_BY_ID_CACHE.get(user_id)
+    if cached is not None:
+        return User.from_row(cached)
+    
+    if _PG_POOL is None:
+        return await asyncio.to_thread(get_user_by_id, _SESSION_SINGLETON, user_id)
+    
+    try:
+        async with _PG_POOL.acquire() as conn:
+            row = await conn.fetchrow(_SELECT_USER_BY_ID, user_id)
+        return _user_from_record(row)
+    except _PG_ERRORS:
+        log.exception("Error getting user by ID")
+        return None
+
+
+async def get_user_by_email_async(email: str) -> Optional[User]:
+    """Get user by email (case-insensitive) over asyncpg"""
+    with _USER_CACHE_LOCK:
+        cached = _USER_BY_EMAIL_CACHE.get(_email_key(email))
+    if cached is not None:
+        return User.from_row(cached)
+    
+    if _PG_POOL is None:
+        return await asyncio.to_thread(get_user_by_email, _SESSION_SINGLETON, email)
+    
+    try:
+        async with _PG_POOL.acquire() as conn:
+            row = await conn.fetchrow(_SELECT_USER_BY_EMAIL, email.lower())
+        return _user_from_record(row)
+    except _PG_ERRORS:
+        log.exception("Error getting user by email")
+        return None
+
+
+async def get_user_ips_async(user_id: str) -> list:
+    """Get all registered IP addresses for a user over asyncpg"""
+    if _PG_POOL is None:
+        return await asyncio.to_thread(get_user_ips, _SESSION_SINGLETON, user_id)
+    
+    try:
+        async with _PG_POOL.acquire() as conn:
+            rows = await conn.fetch(f"SELECT {USER_IP_COLUMNS} FROM user_ips WHERE user_id = $1", user_id)
+        return [_record_to_dict(row) for row in rows]
+    except _PG_ERRORS:
+        log.exception("Error getting user IPs")
+        return []
+
+
+async def get_user_sessions_async(user_id: str) -> list:
+    """Get all sessions for a user over asyncpg"""
+    if _PG_POOL is None:
+        return await asyncio.to_thread(get_user_sessions, _SESSION_SINGLETON, user_id)
+    
+    try:
+        async with _PG_POOL.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {SESSION_LIST_COLUMNS} FROM sessions WHERE user_id = $1 ORDER BY last_activity DESC",
+                user_id
+            )
+        return [_record_to_dict(row) for row in rows]
+    except _PG_ERRORS:
+        log.exception("Error getting user sessions")
+        return []
+
+
+async def get_session_owner_async(session_id: str) -> Optional[str]:
+    """Get the owner (user_id) of a session over asyncpg"""
+    owner = _cached_session_owner(session_id)
+    if owner is not None:
+        return owner
+    
+    if _PG_POOL is None:
+        return await asyncio.to_thread(get_session_owner, _SESSION_SINGLETON, session_id)
+    
+    try:
+        async with _PG_POOL.acquire() as conn:
+            owner = await conn.fetchval(
+                "SELECT user_id FROM sessions WHERE session_id = $1", session_id
+            )
+        owner = str(owner) if owner else None
+        _cache_session_owner(session_id, owner)
+        return owner
+    except _PG_ERRORS:
+        log.exception("Error getting session owner")
+        return None
+
+
+async def verify_session_ownership_async(session_id: str, user_id: str) -> bool:
+    """Verify that a session belongs to a specific user over asyncpg"""
+    return user_id is not None and await get_session_owner_async(session_id) == user_id
+
+
+async def get_messages_for_session_async(
+    session_id: str,
+    after_index: int = -1,
+    limit: int = 200,
+    fields: str = MESSAGE_COLUMNS
+) -> list:
+    """Retrieve a keyset-paginated page of messages for a session over asyncpg"""
+    if _PG_POOL is None:
+        return await asyncio.to_thread(get_messages_for_session, _SESSION_SINGLETON, session_id, after_index, limit, fields)
+    
+    try:
+        # fields is one of the module's column constants, never user input
+        async with _PG_POOL.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {fields} FROM messages WHERE session_id = $1 AND message_index > $2 "
+                "ORDER BY message_index LIMIT $3",
+                session_id, after_index, limit
+            )
+        return [_record_to_dict(row) for row in rows]
+    except _PG_ERRORS:
+        log.exception("Error getting messages for session")
+        return []
+
+
+# =============================================
+# ASYNC SUPABASE CLIENT
+# =============================================
+# Post-login writes that don't depend on each other are issued concurrently
+# through supabase-py's async client, so their latency is the slowest call
+# rather than the sum of all of them.
+
+_async_supabase: Optional[AsyncClient] = None
+_async_supabase_http: Optional[httpx.AsyncClient] = None
+
+
+async def init_async_supabase() -> Optional[AsyncClient]:
+    """Create the async Supabase client (call once at app startup)"""
+    global _async_supabase, _async_supabase_http
+    if _async_supabase is not None or not (SUPABASE_URL and SUPABASE_KEY):
+        return _async_supabase
+    
+    _async_supabase_http = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(retries=3, http2=True, limits=_HTTP_LIMITS),
+        timeout=_HTTP_TIMEOUT
+    )
+    _async_supabase = await acreate_client(
+        SUPABASE_URL,
+        SUPABASE_KEY,
+        options=AsyncClientOptions(
+            postgrest_client_timeout=30,
+            storage_client_timeout=30,
+            httpx_client=_async_supabase_http
+        )
+    )
+    await _warm_async_supabase()
+    return _async_supabase
+
+
+async def _warm_async_supabase() -> None:
+    """
+    Open the async client's HTTP/2 connection with a one-row read so the first
+    real request doesn't pay for the TCP and TLS handshakes. HTTP/2 multiplexes
+    every later request over this connection.
+    """
+    try:
+        await _async_supabase.table("users").select("id").limit(1).execute()
+    except _DB_ERRORS as e:
+        log.warning("Could not warm the async Supabase connection: %s", e)
+
+
+async def close_async_supabase() -> None:
+    """Close the async Supabase client's connections (call once at app shutdown)"""
+    global _async_supabase, _async_supabase_http
+    if _async_supabase_http is not None:
+        await _async_supabase_http.aclose()
+    _async_supabase = None
+    _async_supabase_http = None
+
+
+async def acreate_user(
+    user_id: str,
+    email: str,
+    username: str,
+    password: Optional[str] = None,
+    auth_provider: str = "local"
+) -> User:
+    """Create a new user via the async client"""
+    if _async_supabase is None:
+        return await asyncio.to_thread(
+            create_user, _SESSION_SINGLETON, user_id, email, username, password, auth_provider
+        )
+    
+    now = _now_iso()
+    response = await _async_supabase.table("users").insert({
+        "id": user_id,
+        "email": email.lower(),
+        "username": username,
+        "password": password,
+        "auth_provider": auth_provider,
+        "created_at": now,
+        "last_login": now,
+        "is_active": True
+    }).execute()
+    invalidate_user_cache(user_id, email)
+    
+    if response.data:
+        return User.from_row(response.data[0])
+    raise UserCreationError("Failed to create user")
+
+
+async def aupdate_user_last_login(user: User) -> User:
+    """Update user's last login timestamp via the async client"""
+    try:
+        now = _now_iso()
+        await _async_supabase.table("users").update(
+            {"last_login": now}, returning=ReturnMethod.minimal
+        ).eq("id", user.id).execute()
+        invalidate_user_cache(user.id, user.email)
+        user.last_login = _parse_datetime(now)
+    except _DB_ERRORS:
+        log.exception("Error updating last login")
+    return user
+
+
+async def aupdate_user_password(user: User, hashed_password: str) -> bool:
+    """Replace a user's stored password hash via the async client"""
+    if _async_supabase is None:
+        return await asyncio.to_thread(update_user_password, _SESSION_SINGLETON, user, hashed_password)
+    
+    try:
+        await _async_supabase.table("users").update(
+            {"password": hashed_password}, returning=ReturnMethod.minimal
+        ).eq("id", user.id).execute()
+        invalidate_user_cache(user.id, user.email)
+        return True
+    except _DB_ERRORS:
+        log.exception("Error updating password")
+        return False
+
+async def atrack_user_ip(user_id: str, ip_address: str, user_agent: str = None) -> bool:
+    """Register or refresh an IP address via the async client. Returns True if new."""
+    if _async_supabase is None:
+        return await asyncio.to_thread(track_user_ip, _SESSION_SINGLETON, user_id, ip_address, user_agent)
+    
+    try:
+        ip_data = {"user_id": user_id, "ip_address": ip_address, "last_seen": _now_iso()}
+        if user_agent:
+            ip_data["user_agent"] = user_agent
+        response = await _async_supabase.table("user_ips").upsert(
+            ip_data, on_conflict="user_id,ip_address", ignore_duplicates=False
+        ).execute()
+        if response.data:
+            row = response.data[0]
+            return row.get("first_seen") == row.get("last_seen")
+        return True
+    except _DB_ERRORS:
+        log.exception("Error tracking IP")
+        return True
+
+
+async def acreate_user_session(user_id: str, ip_address: str = None, session_id: str = None) -> Optional[str]:
+    """Create a new chat session for a user via the async client"""
+    if _async_supabase is None:
+        return await asyncio.to_thread(create_user_session, _SESSION_SINGLETON, user_id, ip_address, session_id)
+    
+    try:
+        final_session_id = session_id or new_id()
+        now = _now_iso()
+        response = await _async_supabase.table("sessions").insert({
+            "session_id": final_session_id,
+            "user_id": user_id,
+            "ip_address": ip_address,
+            "created_at": now,
+            "last_activity": now,
+            "title": "New Conversation"
+        }).execute()
+        if response.data:
+            _cache_session_owner(final_session_id, user_id)
+            log.info("Created session %s for user %s from IP %s", final_session_id, user_id, ip_address)
+            return final_session_id
+        return None
+    except _DB_ERRORS:
+        log.exception("Error creating session")
+        return None
+
+
+async def ahandle_login(
+    user: User,
+    ip_address: str,
+    user_agent: str = None,
+    session_id: str = None
+) -> Dict[str, Any]:
+    """
+    Async counterpart of handle_login. Tries the stored function first; if it
+    is unavailable, updates last_login and tracks the IP concurrently, then
+    creates a session only if the IP turned out to be new.
+    """
+    if _async_supabase is None:
+        return await asyncio.to_thread(
+            handle_login, _SESSION_SINGLETON, user, ip_address, user_agent, session_id
+        )
+    
+    try:
+        response = await _async_supabase.rpc(
+            "handle_login", _handle_login_params(user, ip_address, user_agent, session_id)
+        ).execute()
+        return _handle_login_result(response.data, user, ip_address)
+    except _DB_ERRORS as e:
+        log.warning("handle_login RPC failed, falling back to separate queries: %s", e)
+    
+    user, is_new_ip = await asyncio.gather(
+        aupdate_user_last_login(user),
+        atrack_user_ip(user.id, ip_address, user_agent)
+    )
+    new_session_id = await acreate_user_session(user.id, ip_address, session_id) if is_new_ip else None
+    return {"user": user, "is_new_ip": is_new_ip, "session_id": new_session_id}
+
+
+async def ahandle_signup(
+    user_id: str,
+    email: str,
+    username: str,
+    password: Optional[str],
+    ip_address: str,
+    user_agent: str = None,
+    auth_provider: str = "local"
+) -> Dict[str, Any]:
+    """
+    Async counterpart of handle_signup. Tries the stored function first; if it
+    is unavailable, creates the user, then tracks the IP and opens a session
+    concurrently.
+    """
+    if _async_supabase is None:
+        return await asyncio.to_thread(
+            handle_signup, _SESSION_SINGLETON, user_id, email, username, password,
+            ip_address, user_agent, auth_provider
+        )
+    
+    params = _handle_signup_params(user_id, email, username, password, ip_address, user_agent, auth_provider)
+    try:
+        response = await _async_supabase.rpc("handle_signup", params).execute()
+        return _handle_signup_result(response.data, user_id, email, ip_address)
+    except _DB_ERRORS as e:
+        log.warning("handle_signup RPC failed, falling back to separate queries: %s", e)
+    
+    user = await acreate_user(user_id, email, username, password, auth_provider)
+    _, new_session_id = await asyncio.gather(
+        atrack_user_ip(user_id, ip_address, user_agent),
+        acreate_user_session(user_id, ip_address)
+    )
+    return {"user": user, "session_id": new_session_id}
+
+
+async def adelete_user_session(session_id: str, user_id: str) -> bool:
+    """Delete a session via the async client, only if it belongs to the user"""
+    if _async_supabase is None:
+        return await asyncio.to_thread(delete_user_session, _SESSION_SINGLETON, session_id, user_id)
+    
+    try:
+        response = await _async_supabase.table("sessions").delete().eq(
+            "session_id", session_id
+        ).eq("user_id", user_id).execute()
+        invalidate_session_owner(session_id)
+        return bool(response.data)
+    except _DB_ERRORS:
+        log.exception("Error deleting session")
+        return False
+
+
+async def aupdate_session_title(session_id: str, title: str) -> bool:
+    """Update the title of a session via the async client"""
+    if _async_supabase is None:
+        return await asyncio.to_thread(update_session_title, _SESSION_SINGLETON, session_id, title)
+    
+    try:
+        await _async_supabase.table("sessions").update(
+            {"title": title, "last_activity": _now_iso()}, returning=ReturnMethod.minimal
+        ).eq("session_id", session_id).execute()
+        return True
+    except _DB_ERRORS:
+        log.exception("Error updating session title")
+        return False
+
+
+if __name__ == "__main__":
+    print_setup_instructions()
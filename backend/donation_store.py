@@ -0,0 +1,131 @@
+"""
+Donation records for the Paystack "buy me a coffee" flow
+Kept in a SQLite file so they survive restarts and are shared by every
+uvicorn worker on the host; calls run in a worker thread
+"""
+
+import os
+import json
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+
+DONATIONS_DB_PATH = os.getenv(
+    "DONATIONS_DB_PATH", str(Path(__file__).parent / "donations.db")
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS donations (
+    reference TEXT PRIMARY KEY,
+    email TEXT,
+    amount INTEGER NOT NULL DEFAULT 0,
+    name TEXT,
+    message TEXT,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    verified_at TEXT,
+    webhook_received TEXT,
+    payment_data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_donations_status_created
+    ON donations (status, created_at DESC);
+"""
+
+_COLUMNS = (
+    "reference", "email", "amount", "name", "message", "status",
+    "created_at", "verified_at", "webhook_received", "payment_data"
+)
+
+
+def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    donation = dict(row)
+    if donation["payment_data"]:
+        donation["payment_data"] = json.loads(donation["payment_data"])
+    return donation
+
+
+class DonationStore:
+    """
+    SQLite-backed donation records with a memoized success aggregate.
+    The aggregate is reused until this process writes or SQLite's
+    data_version shows another worker committed.
+    """
+
+    def __init__(self, path: str = DONATIONS_DB_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        # (data_version, (count, total_amount)) or None after a local write
+        self._totals: Optional[Tuple[int, Tuple[int, int]]] = None
+
+    def _get(self, reference: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM donations WHERE reference = ?", (reference,)
+            ).fetchone()
+        return _row_to_dict(row) if row is not None else None
+
+    def _save(self, donation: Dict[str, Any]) -> None:
+        values = dict(donation)
+        if values.get("payment_data") is not None:
+            values["payment_data"] = json.dumps(values["payment_data"])
+        columns = [column for column in _COLUMNS if column in values]
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != "reference")
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO donations ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (reference) DO UPDATE SET {updates}",
+                [values[column] for column in columns]
+            )
+            self._totals = None
+
+    def _update(self, reference: str, fields: Dict[str, Any]) -> bool:
+        if "payment_data" in fields:
+            fields = {**fields, "payment_data": json.dumps(fields["payment_data"])}
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE donations SET {assignments} WHERE reference = ?",
+                [*fields.values(), reference]
+            )
+            self._totals = None
+        return cursor.rowcount > 0
+
+    def _stats(self, recent: int) -> Tuple[int, int, List[Dict[str, Any]]]:
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._totals is None or self._totals[0] != data_version:
+                count, total = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM donations WHERE status = 'success'"
+                ).fetchone()
+                self._totals = (data_version, (count, total))
+            count, total = self._totals[1]
+            rows = self._conn.execute(
+                "SELECT name, amount, message, created_at FROM donations "
+                "WHERE status = 'success' ORDER BY created_at DESC LIMIT ?",
+                (recent,)
+            ).fetchall()
+        return count, total, [dict(row) for row in rows]
+
+    async def get(self, reference: str) -> Optional[Dict[str, Any]]:
+        """A donation by Paystack reference, or None"""
+        return await asyncio.to_thread(self._get, reference)
+
+    async def save(self, donation: Dict[str, Any]) -> None:
+        """Insert a donation, or overwrite the given fields if the reference exists"""
+        await asyncio.to_thread(self._save, donation)
+
+    async def update(self, reference: str, **fields: Any) -> bool:
+        """Set fields on an existing donation. Returns False if it does not exist."""
+        return await asyncio.to_thread(self._update, reference, fields)
+
+    async def stats(self, recent: int = 5) -> Tuple[int, int, List[Dict[str, Any]]]:
+        """Count and total of successful donations, plus the most recent ones"""
+        return await asyncio.to_thread(self._stats, recent)
+
+    def close(self) -> None:
+        self._conn.close()
@@ -5,54 +5,81 @@ Provides RESTful API endpoints for the frontend
 
 import sys
 import os
+import logging
 from pathlib import Path
+from urllib.parse import quote, unquote
+from email.utils import formatdate
 
 # Add backend directory to path to ensure rag module can be found
 backend_dir = Path(__file__).parent.resolve()
 if str(backend_dir) not in sys.path:
     sys.path.insert(0, str(backend_dir))
 
+# Log through a queue so handlers never block writing to stdout
+from app_logging import setup_logging
+setup_logging()
+log = logging.getLogger(__name__)
+
 # Load environment variables from backend/.env file
 from dotenv import load_dotenv
 env_path = backend_dir / ".env"
 if env_path.exists():
     load_dotenv(env_path)
-    print(f"✅ Loaded environment variables from {env_path}")
+    log.info("✅ Loaded environment variables from %s", env_path)
 else:
-    print(f"⚠️ No .env file found at {env_path}")
+    log.warning("⚠️ No .env file found at %s", env_path)
     
 from supabase import create_client, Client
-from rag.rag_engine import RAGEngine
-from fastapi import FastAPI, HTTPException, Request, Depends
+from rag.rag_engine import RAGEngine, RAGEngineError, DocumentLoadError
+from response_cache import SmartResponseCache
+from semantic_cache import SemanticCache
+from session_store import Session, SessionNotFound, create_stores
+from donation_store import DonationStore
+from fastapi import FastAPI, HTTPException, Request, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+from starlette.background import BackgroundTask
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Dict, Any, Optional
-from datetime import datetime, timedelta
-from contextlib import asynccontextmanager
-import uuid
-from openai import OpenAI
+from typing import List, Dict, Any, Optional, Iterator
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager, AsyncExitStack
+import asyncio
+import anyio.to_thread
+import orjson
+import threading
+import time
+from openai import AsyncOpenAI
 import io
 import httpx
 import hashlib
+import hmac
 import secrets
 import jwt
+from cachetools import TTLCache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
 # Database imports
 from database import (
-    get_db, get_db_session, get_user_by_id, get_user_by_email,
-    create_user, update_user_last_login, is_new_ip_for_user,
-    register_user_ip, update_ip_last_seen, create_user_session, get_user_sessions,
-    update_session_title, update_session_activity, get_session_owner,
-    verify_session_ownership, delete_user_session
+    new_id, ahandle_login, ahandle_signup, aupdate_user_password,
+    acreate_user_session, aupdate_session_title, adelete_user_session,
+    queue_session_activity,
+    init_pg_pool, close_pg_pool, run_session_activity_flusher,
+    init_async_supabase, close_async_supabase, get_user_by_id_async, get_user_by_email_async,
+    get_user_sessions_async, get_session_owner_async
 )
 
 # JWT Configuration
 JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_hex(32))
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
+# Encoded once; PyJWT would otherwise convert the str secret on every sign/verify
+_JWT_KEY = JWT_SECRET.encode()
 
 # Google OAuth Configuration
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID", "")
@@ -65,18 +92,36 @@ PAYSTACK_SECRET_KEY = os.getenv("PAYSTACK_SECRET_KEY", "")
 PAYSTACK_PUBLIC_KEY = os.getenv("PAYSTACK_PUBLIC_KEY", "")
 PAYSTACK_BASE_URL = "https://api.paystack.co"
 
+# Shared outbound HTTP clients (created in lifespan) so Google and Paystack
+# calls reuse pooled keep-alive connections instead of a new TLS handshake each
+OUTBOUND_HTTP_TIMEOUT = 10.0
+OUTBOUND_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+http_client: Optional[httpx.AsyncClient] = None
+paystack_client: Optional[httpx.AsyncClient] = None
+# TTS gets its own larger pool since synthesis requests are long-lived
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30)
+openai_client: Optional[AsyncOpenAI] = None
+
+# Worker threads for blocking RAG/LLM calls (AnyIO's default is 40)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "64"))
+
 # Global RAG engine instance
 # rag_engine: Optional[RAGEngine] = None
 
-# Session storage with owner tracking
-# Format: {session_id: {"owner_id": user_id or None, "created_at": ..., ...}}
-sessions: Dict[str, Dict[str, Any]] = {}
+# Session metadata (with owner tracking) and feedback storage.
+# Backed by Redis when REDIS_URL is set so all workers share it.
+session_store, feedback_store = create_stores()
 
-# Track which sessions belong to which user (for fast lookup)
-user_session_map: Dict[str, set] = {}  # {user_id: {session_id1, session_id2, ...}}
+# Paystack donations, persisted to SQLite
+donation_store = DonationStore()
 
 rag_engine = RAGEngine()
-openai_client = OpenAI()
+
+# Answers to opening questions, shared across sessions. Only the first message
+# of a session is served from here since later answers depend on history.
+response_cache = SmartResponseCache(maxsize=2048, ttl=3600)
+# Second tier for paraphrases of cached questions, using the RAG embedder
+semantic_cache = SemanticCache(rag_engine.embeddings.embed_query, threshold=0.95, maxsize=10_000)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -84,21 +129,50 @@ async def lifespan(app: FastAPI):
     Lifespan context manager for startup and shutdown events
     """
 
-    print("Starting up Policy Assistant API...")
-    print("Initializing RAG Engine...")
+    global http_client, paystack_client, openai_client
+
+    log.info("Starting up Policy Assistant API...")
+    # RAG and LLM calls hold a worker thread for seconds at a time
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    http_client = httpx.AsyncClient(http2=True, timeout=OUTBOUND_HTTP_TIMEOUT, limits=OUTBOUND_HTTP_LIMITS)
+    paystack_client = httpx.AsyncClient(
+        base_url=PAYSTACK_BASE_URL,
+        headers={"Authorization": f"Bearer {PAYSTACK_SECRET_KEY}"},
+        timeout=OUTBOUND_HTTP_TIMEOUT,
+        limits=OUTBOUND_HTTP_LIMITS
+    )
+    openai_client = AsyncOpenAI(
+        http_client=httpx.AsyncClient(http2=True, timeout=30.0, limits=OPENAI_HTTP_LIMITS)
+    )
+    # Both open their connections up front; neither depends on the other
+    await asyncio.gather(init_pg_pool(), init_async_supabase())
+    activity_flusher = asyncio.create_task(run_session_activity_flusher())
+    log.info("Initializing RAG Engine...")
 
     # Explicitly initialize the RAG engine (loads vector DB, etc.)
     try:
         rag_engine.initialize(force_reload=False)
-        print("RAG Engine initialized successfully!")
+        log.info("RAG Engine initialized successfully!")
     except Exception as e:
-        print(f"Error initializing RAG engine: {e}")
-        print("API will start but RAG functionality may be unavailable.")
+        log.error("Error initializing RAG engine: %s", e)
+        log.warning("API will start but RAG functionality may be unavailable.")
 
     yield
 
     # Shutdown
-    print("Shutting down Policy Assistant API...")
+    log.info("Shutting down Policy Assistant API...")
+    activity_flusher.cancel()
+    try:
+        await activity_flusher
+    except asyncio.CancelledError:
+        pass
+    await close_pg_pool()
+    await close_async_supabase()
+    await session_store.close()
+    donation_store.close()
+    await http_client.aclose()
+    await paystack_client.aclose()
+    await openai_client.close()
 
 
 # Initialize FastAPI app with lifespan
@@ -119,8 +193,22 @@ app.add_middleware(
     expose_headers=["Content-Type", "Content-Disposition"],
 )
 
+# Compress JSON responses (chat sources can be large); event streams, audio and
+# images are left alone by the middleware's default exclusions, and PDFs are
+# added since their streams are already deflated
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
+    compresslevel=5,
+    exclude_content_types=(*DEFAULT_EXCLUDED_CONTENT_TYPES, "application/pdf")
+)
+
 
 # Pydantic models
+# Roles the RAG prompts are written for; anything else is answered as a taxpayer
+VALID_ROLES = frozenset(("tax_lawyer", "taxpayer", "company"))
+
+
 class ChatRequest(BaseModel):
     """Request model for chat endpoint"""
     message: str = Field(..., description="User message", min_length=1)
@@ -223,38 +311,105 @@ class UserProfile(BaseModel):
 # AUTHENTICATION HELPER FUNCTIONS
 # =============================================
 
+# OWASP's Argon2id baseline: 46 MiB, one pass, one lane. Concurrent logins
+# are spread over threadpool workers rather than Argon2 lanes.
+password_hasher = PasswordHasher(time_cost=1, memory_cost=46 * 1024, parallelism=1)
+
+
 def hash_password(password: str) -> str:
-    """Hash password using SHA-256 with salt"""
-    salt = JWT_SECRET[:16]
-    return hashlib.sha256(f"{salt}{password}".encode()).hexdigest()
+    """Hash password using Argon2id (slow by design, call via run_in_threadpool)"""
+    return password_hasher.hash(password)
+
+
+def password_needs_rehash(hashed: str) -> bool:
+    """Whether a stored hash is legacy SHA-256 or uses outdated Argon2 parameters"""
+    if not hashed.startswith("$argon2"):
+        return True
+    try:
+        return password_hasher.check_needs_rehash(hashed)
+    except InvalidHashError:
+        return True
+
+
+async def rehash_password(user, password: str) -> None:
+    """Store a fresh Argon2id hash for a user who just logged in successfully"""
+    hashed_password = await run_in_threadpool(hash_password, password)
+    await aupdate_user_password(user, hashed_password)
+    forget_user_tokens(user.id)
 
 
 def verify_password(password: str, hashed: str) -> bool:
-    """Verify password against hash"""
-    return hash_password(password) == hashed
+    """Verify password against an Argon2 hash or a legacy salted SHA-256 hash"""
+    if hashed.startswith("$argon2"):
+        try:
+            return password_hasher.verify(hashed, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    # Accounts created before the switch to Argon2
+    salt = JWT_SECRET[:16]
+    legacy_hash = hashlib.sha256(f"{salt}{password}".encode()).hexdigest()
+    return hmac.compare_digest(legacy_hash, hashed)
 
 
 def create_jwt_token(user_id: str, email: str) -> str:
     """Create JWT token for authenticated user"""
+    issued_at = int(time.time())
     payload = {
         "sub": user_id,
         "email": email,
-        "exp": datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS),
-        "iat": datetime.utcnow()
+        "exp": issued_at + JWT_EXPIRATION_HOURS * 3600,
+        "iat": issued_at
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return jwt.encode(payload, _JWT_KEY, algorithm=JWT_ALGORITHM)
+
+
+# Recently verified tokens, so repeat requests from a client skip the HMAC check.
+# Keyed by a truncated SHA-256 of the token so raw bearer tokens aren't held.
+_JWT_CACHE: TTLCache = TTLCache(maxsize=20_000, ttl=30)
+_JWT_CACHE_LOCK = threading.Lock()
+_JWT_DECODE_OPTIONS = {"require": ["exp", "sub"]}
+_JWT_ALGORITHMS = [JWT_ALGORITHM]
+
+
+def _jwt_cache_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()[:16]
+
+
+def forget_token(token: str) -> None:
+    """Drop a token's cached payload so its next use is verified again"""
+    with _JWT_CACHE_LOCK:
+        _JWT_CACHE.pop(_jwt_cache_key(token), None)
+
+
+def forget_user_tokens(user_id: str) -> None:
+    """Drop every cached payload for a user, e.g. after their password changes"""
+    with _JWT_CACHE_LOCK:
+        stale = [key for key, payload in _JWT_CACHE.items() if payload["sub"] == user_id]
+        for key in stale:
+            _JWT_CACHE.pop(key, None)
 
 
 def decode_jwt_token(token: str) -> Optional[Dict[str, Any]]:
     """Decode and verify JWT token"""
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    cache_key = _jwt_cache_key(token)
+    with _JWT_CACHE_LOCK:
+        payload = _JWT_CACHE.get(cache_key)
+    # The cache TTL can outlast the token itself, so expiry is re-checked on a hit
+    if payload is not None and payload["exp"] > time.time():
         return payload
+
+    try:
+        payload = jwt.decode(token, _JWT_KEY, algorithms=_JWT_ALGORITHMS, options=_JWT_DECODE_OPTIONS)
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+    with _JWT_CACHE_LOCK:
+        _JWT_CACHE[cache_key] = payload
+    return payload
+
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Optional[Dict[str, Any]]:
     """Get current user from JWT token"""
@@ -269,19 +424,19 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     
     user_id = payload.get("sub")
     if user_id:
-        db = get_db_session()
-        try:
-            user = get_user_by_id(db, user_id)
-            if user:
-                return user.to_dict()
-        finally:
-            db.close()
+        user = await get_user_by_id_async(user_id)
+        if user:
+            return user.to_dict()
     
     return None
 
 
-# Feedback storage (in production, use a database)
-feedback_store: Dict[str, List[Dict[str, Any]]] = {}
+async def resolve_client_ip(request: Request) -> str:
+    """Client IP address, preferring the first X-Forwarded-For hop when behind a proxy"""
+    client_ip = request.headers.get("x-forwarded-for", "").partition(",")[0].strip()
+    if client_ip:
+        return client_ip
+    return request.client.host if request.client else "unknown"
 
 
 # API Endpoints
@@ -311,153 +466,131 @@ async def health_check():
 # =============================================
 
 @app.post("/auth/signup", response_model=AuthResponse)
-async def signup(request: SignupRequest, req: Request):
+async def signup(request: SignupRequest, req: Request, client_ip: str = Depends(resolve_client_ip)):
     """
     Register a new user
     
     Creates a new user account with email and password
     Also registers the IP and creates an initial session
     """
-    db = get_db_session()
-    try:
-        # Get client IP address
-        client_ip = req.client.host if req.client else "unknown"
-        forwarded_for = req.headers.get("x-forwarded-for")
-        if forwarded_for:
-            client_ip = forwarded_for.split(",")[0].strip()
-        
-        user_agent = req.headers.get("user-agent", "")
-        
-        # Check if email already exists
-        existing_user = get_user_by_email(db, request.email)
-        if existing_user:
-            raise HTTPException(
-                status_code=400,
-                detail="An account with this email already exists"
-            )
-        
-        # Create new user
-        user_id = str(uuid.uuid4())
-        hashed_password = hash_password(request.password)
-        
-        user = create_user(
-            db=db,
-            user_id=user_id,
-            email=request.email,
-            username=request.username,
-            password=hashed_password,
-            auth_provider="local"
-        )
-        
-        # Register the IP address for this new user
-        register_user_ip(db, user_id, client_ip, user_agent)
-        
-        # Create initial session for this user
-        new_session_id = create_user_session(db, user_id, client_ip)
-        
-        # Create JWT token
-        token = create_jwt_token(user_id, user.email)
-        
-        print(f"👤 New user registered: {request.email} from IP {client_ip}")
-        
-        return AuthResponse(
-            status="success",
-            message="Account created successfully",
-            token=token,
-            user={
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "created_at": user.created_at.isoformat(),
-                "new_session_id": new_session_id,
-                "is_new_ip": True
-            }
+    user_agent = req.headers.get("user-agent", "")
+    
+    # Check if email already exists
+    existing_user = await get_user_by_email_async(request.email)
+    if existing_user:
+        raise HTTPException(
+            status_code=400,
+            detail="An account with this email already exists"
         )
-    finally:
-        db.close()
+    
+    # Create new user
+    user_id = new_id()
+    hashed_password = await run_in_threadpool(hash_password, request.password)
+    
+    # Create the user, register the IP address and open an initial session
+    signup_result = await ahandle_signup(
+        user_id=user_id,
+        email=request.email,
+        username=request.username,
+        password=hashed_password,
+        ip_address=client_ip,
+        user_agent=user_agent
+    )
+    user = signup_result["user"]
+    new_session_id = signup_result["session_id"]
+    
+    # Create JWT token
+    token = create_jwt_token(user_id, user.email)
+    
+    log.info("👤 New user registered: %s from IP %s", request.email, client_ip)
+    
+    return AuthResponse(
+        status="success",
+        message="Account created successfully",
+        token=token,
+        user={
+            "id": user.id,
+            "email": user.email,
+            "username": user.username,
+            "created_at": user.created_at.isoformat(),
+            "new_session_id": new_session_id,
+            "is_new_ip": True
+        }
+    )
 
 
 @app.post("/auth/login", response_model=AuthResponse)
-async def login(request: LoginRequest, req: Request):
+async def login(
+    request: LoginRequest,
+    req: Request,
+    background_tasks: BackgroundTasks,
+    client_ip: str = Depends(resolve_client_ip)
+):
     """
     Authenticate user and return JWT token
     Creates a new session if logging in from a new IP address
     """
-    db = get_db_session()
-    try:
-        # Get client IP address
-        client_ip = req.client.host if req.client else "unknown"
-        # Check for forwarded IP (if behind proxy)
-        forwarded_for = req.headers.get("x-forwarded-for")
-        if forwarded_for:
-            client_ip = forwarded_for.split(",")[0].strip()
-        
-        user_agent = req.headers.get("user-agent", "")
-        
-        # Find user by email
-        user = get_user_by_email(db, request.email)
-        
-        if not user:
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid email or password"
-            )
-        
-        # Check if user has a password (not OAuth-only user)
-        if not user.password:
-            raise HTTPException(
-                status_code=401,
-                detail="Please use Google Sign-In for this account"
-            )
-        
-        # Verify password
-        if not verify_password(request.password, user.password):
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid email or password"
-            )
-        
-        # Update last login
-        user = update_user_last_login(db, user)
-        
-        # Check if this is a new IP address for this user
-        new_session_id = None
-        is_new_ip = is_new_ip_for_user(db, user.id, client_ip)
-        
-        if is_new_ip:
-            # Register the new IP
-            register_user_ip(db, user.id, client_ip, user_agent)
-            # Create a new session for this IP
-            new_session_id = create_user_session(db, user.id, client_ip)
-            print(f"🌐 New IP detected for {request.email}: {client_ip} - Created session {new_session_id}")
-        else:
-            # Update last seen for existing IP
-            update_ip_last_seen(db, user.id, client_ip)
-            print(f"🔑 User logged in from known IP: {request.email} ({client_ip})")
-        
-        # Create JWT token
-        token = create_jwt_token(user.id, user.email)
-        
-        return AuthResponse(
-            status="success",
-            message="Login successful",
-            token=token,
-            user={
-                "id": user.id,
-                "email": user.email,
-                "username": user.username or user.email.split("@")[0],
-                "created_at": user.created_at.isoformat() if user.created_at else None,
-                "last_login": user.last_login.isoformat() if user.last_login else None,
-                "new_session_id": new_session_id,
-                "is_new_ip": is_new_ip
-            }
+    user_agent = req.headers.get("user-agent", "")
+    
+    # Find user by email
+    user = await get_user_by_email_async(request.email)
+    
+    if not user:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid email or password"
         )
-    finally:
-        db.close()
+    
+    # Check if user has a password (not OAuth-only user)
+    if not user.password:
+        raise HTTPException(
+            status_code=401,
+            detail="Please use Google Sign-In for this account"
+        )
+    
+    # Verify password
+    if not await run_in_threadpool(verify_password, request.password, user.password):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid email or password"
+        )
+    
+    # Upgrade legacy or weaker hashes once the response has been sent
+    if password_needs_rehash(user.password):
+        background_tasks.add_task(rehash_password, user, request.password)
+    
+    # Update last login, track the IP and create a session for a new IP
+    login_result = await ahandle_login(user, client_ip, user_agent)
+    user = login_result["user"]
+    is_new_ip = login_result["is_new_ip"]
+    new_session_id = login_result["session_id"]
+    
+    if is_new_ip:
+        log.info("🌐 New IP detected for %s: %s - Created session %s", request.email, client_ip, new_session_id)
+    else:
+        log.info("🔑 User logged in from known IP: %s (%s)", request.email, client_ip)
+    
+    # Create JWT token
+    token = create_jwt_token(user.id, user.email)
+    
+    return AuthResponse(
+        status="success",
+        message="Login successful",
+        token=token,
+        user={
+            "id": user.id,
+            "email": user.email,
+            "username": user.username or user.email.split("@")[0],
+            "created_at": user.created_at.isoformat() if user.created_at else None,
+            "last_login": user.last_login.isoformat() if user.last_login else None,
+            "new_session_id": new_session_id,
+            "is_new_ip": is_new_ip
+        }
+    )
 
 
 @app.get("/auth/me")
-async def get_current_user_profile(current_user: Optional[Dict[str, Any]] = Depends(get_current_user)):
+async def get_current_user_profile(current_user: Optional[Dict[str, Any]] = Depends(get_current_user)) -> Dict[str, Any]:
     """
     Get current authenticated user's profile
     """
@@ -479,15 +612,20 @@ async def get_current_user_profile(current_user: Optional[Dict[str, Any]] = Depe
     }
 
 
+_LOGOUT_RESPONSE = Response(
+    content=orjson.dumps({"status": "success", "message": "Logged out successfully"}),
+    media_type="application/json"
+)
+
+
 @app.post("/auth/logout")
-async def logout():
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     Logout endpoint (client should discard the token)
     """
-    return {
-        "status": "success",
-        "message": "Logged out successfully"
-    }
+    if credentials:
+        forget_token(credentials.credentials)
+    return _LOGOUT_RESPONSE
 
 
 class GoogleAuthRequest(BaseModel):
@@ -495,144 +633,162 @@ class GoogleAuthRequest(BaseModel):
     credential: str = Field(..., description="Google ID token from Sign-In")
 
 
+# Verified Google ID token payloads, since clients often retry the same credential
+_GOOGLE_TOKEN_CACHE: TTLCache = TTLCache(maxsize=5000, ttl=60)
+
+
+async def verify_google_token(credential: str) -> Optional[Dict[str, Any]]:
+    """Verify a Google ID token with Google's tokeninfo endpoint, or None if invalid"""
+    cache_key = hashlib.sha256(credential.encode()).digest()
+    google_data = _GOOGLE_TOKEN_CACHE.get(cache_key)
+    # tokeninfo reports exp as a string of epoch seconds
+    if google_data is not None and int(google_data.get("exp", 0)) > time.time():
+        return google_data
+
+    response = await http_client.get(
+        "https://oauth2.googleapis.com/tokeninfo",
+        params={"id_token": credential}
+    )
+    if response.status_code != 200:
+        return None
+
+    google_data = response.json()
+    _GOOGLE_TOKEN_CACHE[cache_key] = google_data
+    return google_data
+
+
 @app.post("/auth/google")
-async def google_auth(google_request: GoogleAuthRequest, request: Request):
+async def google_auth(google_request: GoogleAuthRequest, client_ip: str = Depends(resolve_client_ip)) -> Dict[str, Any]:
     """
     Authenticate user with Google Sign-In
     
     Verifies the Google ID token and creates/logs in the user
     Creates a new session if logging in from a new IP address
     """
-    db = get_db_session()
-    
-    # Get client IP address
-    client_ip = request.headers.get("x-forwarded-for", "").split(",")[0].strip()
-    if not client_ip:
-        client_ip = request.client.host if request.client else "unknown"
-    
     try:
         # Verify Google ID token
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"https://oauth2.googleapis.com/tokeninfo?id_token={google_request.credential}"
+        google_data = await verify_google_token(google_request.credential)
+        
+        if google_data is None:
+            raise HTTPException(
+                status_code=401,
+                detail="Invalid Google token"
             )
+        
+        # Verify the token is for our app (if GOOGLE_CLIENT_ID is set)
+        if GOOGLE_CLIENT_ID and google_data.get("aud") != GOOGLE_CLIENT_ID:
+            raise HTTPException(
+                status_code=401,
+                detail="Token was not issued for this application"
+            )
+        
+        email = google_data.get("email")
+        if not email:
+            raise HTTPException(
+                status_code=400,
+                detail="Email not provided by Google"
+            )
+        
+        # Check if user exists
+        existing_user = await get_user_by_email_async(email)
+        
+        if existing_user:
+            # Login existing user: update last login, track the IP and
+            # create a session for a new IP
+            login_result = await ahandle_login(existing_user, client_ip)
+            existing_user = login_result["user"]
+            is_new_ip = login_result["is_new_ip"]
+            new_session_id = login_result["session_id"]
+            token = create_jwt_token(existing_user.id, existing_user.email)
             
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=401,
-                    detail="Invalid Google token"
-                )
-            
-            google_data = response.json()
+            if is_new_ip:
+                log.info("🔑 Google user logged in from NEW IP: %s (%s) - New session: %s", email, client_ip, new_session_id)
+            else:
+                log.info("🔑 Google user logged in: %s (%s)", email, client_ip)
             
-            # Verify the token is for our app (if GOOGLE_CLIENT_ID is set)
-            if GOOGLE_CLIENT_ID and google_data.get("aud") != GOOGLE_CLIENT_ID:
-                raise HTTPException(
-                    status_code=401,
-                    detail="Token was not issued for this application"
-                )
+            return {
+                "status": "success",
+                "message": "Login successful",
+                "token": token,
+                "is_new_ip": is_new_ip,
+                "new_session_id": new_session_id,
+                "user": {
+                    "id": existing_user.id,
+                    "email": existing_user.email,
+                    "username": existing_user.username or existing_user.email.split("@")[0],
+                    "created_at": existing_user.created_at.isoformat() if existing_user.created_at else None,
+                    "last_login": existing_user.last_login.isoformat() if existing_user.last_login else None
+                }
+            }
+        else:
+            # Create new user
+            user_id = new_id()
+            google_name = google_data.get("name", email.split("@")[0])
             
-            email = google_data.get("email")
-            if not email:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Email not provided by Google"
-                )
+            # Create the user (stamped as logged in), register the IP and
+            # open an initial session in one round-trip
+            signup_result = await ahandle_signup(
+                user_id=user_id,
+                email=email,
+                username=google_name,
+                password=None,
+                ip_address=client_ip,
+                auth_provider="google"
+            )
+            new_user = signup_result["user"]
+            new_session_id = signup_result["session_id"]
             
-            # Check if user exists
-            existing_user = get_user_by_email(db, email)
+            token = create_jwt_token(user_id, email.lower())
+            log.info("👤 New Google user registered: %s (%s) - Session: %s", email, client_ip, new_session_id)
             
-            if existing_user:
-                # Login existing user
-                existing_user = update_user_last_login(db, existing_user)
-                token = create_jwt_token(existing_user.id, existing_user.email)
-                
-                # Check if this is a new IP for this user
-                is_new_ip = is_new_ip_for_user(db, existing_user.id, client_ip)
-                new_session_id = None
-                
-                if is_new_ip:
-                    # Register the new IP
-                    register_user_ip(db, existing_user.id, client_ip)
-                    # Create a new session for this IP
-                    new_session_id = create_user_session(db, existing_user.id, client_ip)
-                    print(f"🔑 Google user logged in from NEW IP: {email} ({client_ip}) - New session: {new_session_id}")
-                else:
-                    # Update last seen for this IP
-                    update_ip_last_seen(db, existing_user.id, client_ip)
-                    print(f"🔑 Google user logged in: {email} ({client_ip})")
-                
-                return {
-                    "status": "success",
-                    "message": "Login successful",
-                    "token": token,
-                    "is_new_ip": is_new_ip,
-                    "new_session_id": new_session_id,
-                    "user": {
-                        "id": existing_user.id,
-                        "email": existing_user.email,
-                        "username": existing_user.username or existing_user.email.split("@")[0],
-                        "created_at": existing_user.created_at.isoformat() if existing_user.created_at else None,
-                        "last_login": existing_user.last_login.isoformat() if existing_user.last_login else None
-                    }
-                }
-            else:
-                # Create new user
-                user_id = str(uuid.uuid4())
-                google_name = google_data.get("name", email.split("@")[0])
-                
-                new_user = create_user(
-                    db=db,
-                    user_id=user_id,
-                    email=email,
-                    username=google_name,
-                    password=None,
-                    auth_provider="google"
-                )
-                
-                # Update last login for new user
-                new_user = update_user_last_login(db, new_user)
-                
-                # Register IP and create initial session for new user
-                register_user_ip(db, user_id, client_ip)
-                new_session_id = create_user_session(db, user_id, client_ip)
-                
-                token = create_jwt_token(user_id, email.lower())
-                print(f"👤 New Google user registered: {email} ({client_ip}) - Session: {new_session_id}")
-                
-                return {
-                    "status": "success",
-                    "message": "Account created successfully",
-                    "token": token,
-                    "is_new_ip": True,
-                    "new_session_id": new_session_id,
-                    "user": {
-                        "id": new_user.id,
-                        "email": new_user.email,
-                        "username": new_user.username,
-                        "created_at": new_user.created_at.isoformat() if new_user.created_at else None,
-                        "last_login": new_user.last_login.isoformat() if new_user.last_login else None
-                    }
+            return {
+                "status": "success",
+                "message": "Account created successfully",
+                "token": token,
+                "is_new_ip": True,
+                "new_session_id": new_session_id,
+                "user": {
+                    "id": new_user.id,
+                    "email": new_user.email,
+                    "username": new_user.username,
+                    "created_at": new_user.created_at.isoformat() if new_user.created_at else None,
+                    "last_login": new_user.last_login.isoformat() if new_user.last_login else None
                 }
+            }
                 
     except httpx.RequestError as e:
-        print(f"Google auth error: {e}")
+        log.error("Google auth error: %s", e)
         raise HTTPException(
             status_code=500,
             detail="Failed to verify Google token"
         )
-    finally:
-        db.close()
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest, current_user: Optional[Dict[str, Any]] = Depends(get_current_user)):
+async def _authorize_session(session_id: str, user_id: Optional[str], denied_detail: Optional[str] = None) -> Optional[Session]:
     """
-    Main chat endpoint
+    Load a session's metadata and check the caller may use it, raising 403 if not.
+    The owner recorded in the session store is authoritative when present;
+    otherwise the (cached) database owner is consulted.
+    """
+    session_info = await session_store.get(session_id)
+    owner_id = session_info.owner_id if session_info else None
+    if owner_id is None:
+        owner_id = await get_session_owner_async(session_id)
+
+    if owner_id and owner_id != user_id:
+        if denied_detail is None:
+            denied_detail = (
+                "Access denied: This session does not belong to you" if user_id
+                else "Access denied: This session belongs to another user"
+            )
+        raise HTTPException(status_code=403, detail=denied_detail)
+    return session_info
 
-    Processes user messages and returns AI responses with source citations
-    Maintains conversation context across messages in the same session
-    For authenticated users, sessions are linked to their account
+
+async def _begin_chat_turn(request: ChatRequest, current_user: Optional[Dict[str, Any]]):
+    """
+    Verify ownership, create the session if needed and enforce prompt limits
+    Returns (session_id, session_info, is_new_session, user_role, now_iso)
     """
     if rag_engine is None:
         raise HTTPException(
@@ -640,123 +796,305 @@ async def chat(request: ChatRequest, current_user: Optional[Dict[str, Any]] = De
             detail="RAG engine not initialized. Please try again later."
         )
 
-    db = get_db_session()
     user_id = current_user["id"] if current_user else None
+    now_iso = datetime.now().isoformat()
     
     # Get or create session ID
-    session_id = request.session_id or str(uuid.uuid4())
+    # Canonical hyphenated form: sessions.session_id is a UUID column, so
+    # ids read back from the database always come back in this format
+    session_id = request.session_id or new_id()
 
     # SECURITY: Verify session ownership if a session_id was provided
+    session_info = None
     if request.session_id:
-        # Check in-memory ownership first
-        if request.session_id in sessions:
-            session_owner_id = sessions[request.session_id].get("owner_id")
-            if session_owner_id and session_owner_id != user_id:
-                raise HTTPException(
-                    status_code=403, 
-                    detail="Access denied: This conversation belongs to another user"
-                )
-        
-        # Also check database ownership
-        db_session_owner = get_session_owner(db, request.session_id)
-        if db_session_owner:
-            if db_session_owner != user_id:
-                raise HTTPException(
-                    status_code=403, 
-                    detail="Access denied: This conversation belongs to another user"
-                )
+        session_info = await _authorize_session(
+            request.session_id, user_id, "Access denied: This conversation belongs to another user"
+        )
 
 
     # Track if this is a new session
-    is_new_session = session_id not in sessions
+    is_new_session = session_info is None
 
-    # Update session info in memory WITH OWNER TRACKING
+    # Store session info WITH OWNER TRACKING
     if is_new_session:
-        sessions[session_id] = {
-            "owner_id": user_id,  # Track who owns this session
-            "created_at": datetime.now().isoformat(),
-            "message_count": 0,
-            "title": "New Conversation",
-            "guest_prompt_count": 0  # Track guest prompt count
-        }
-        # Track session for user lookup
-        if user_id:
-            if user_id not in user_session_map:
-                user_session_map[user_id] = set()
-            user_session_map[user_id].add(session_id)
+        session_info = Session(
+            session_id=session_id,
+            owner_id=user_id,  # Track who owns this session
+            created_at=now_iso
+        )
+        await session_store.create(session_info)
         # If authenticated and this is a brand new session not from login, create it in DB
         if current_user and not request.session_id:
             try:
-                create_user_session(db, user_id, None, session_id)
+                await acreate_user_session(user_id, None, session_id)
             except Exception as e:
-                print(f"Warning: Could not save session to database: {e}")
+                log.warning("Could not save session to database: %s", e)
 
 
     # Restrict unauthenticated users to 3 prompts per session
     if not current_user:
-        guest_count = sessions[session_id].get("guest_prompt_count", 0)
+        guest_count = session_info.guest_prompt_count
         if guest_count >= 3:
             raise HTTPException(
                 status_code=403,
                 detail="Guest users are limited to 3 prompts. Please sign up or log in to continue."
             )
-        sessions[session_id]["guest_prompt_count"] = guest_count + 1
+        await session_store.incr(session_id, "guest_prompt_count")
 
     # Restrict authenticated users to 10 prompts per session unless they buy a coffee
     if current_user:
-        user_prompt_count = sessions[session_id].get("user_prompt_count", 0)
+        user_prompt_count = session_info.user_prompt_count
         if user_prompt_count >= 10:
             raise HTTPException(
                 status_code=402,
                 detail="You have reached your 10 free prompts. Please buy a coffee to continue using the assistant."
             )
-        sessions[session_id]["user_prompt_count"] = user_prompt_count + 1
+        await session_store.incr(session_id, "user_prompt_count")
 
-    sessions[session_id]["message_count"] += 1
-    sessions[session_id]["last_activity"] = datetime.now().isoformat()
+    message_count = await session_store.incr(session_id, "message_count")
+    await session_store.update(session_id, last_activity=now_iso, last_user_message=request.message)
+    if current_user:
+        # Written to the sessions table in batches by the activity flusher
+        queue_session_activity(session_id, message_count)
 
     # Validate and set user role
-    valid_roles = ["tax_lawyer", "taxpayer", "company"]
-    user_role = request.user_role if request.user_role in valid_roles else "taxpayer"
+    user_role = request.user_role if request.user_role in VALID_ROLES else "taxpayer"
 
-    try:
-        # Get response from RAG engine with user role
-        print(f"🔄 Processing chat request: session={session_id}, user_role={user_role}, authenticated={current_user is not None}")
-        result = rag_engine.chat(request.message, session_id=session_id, user_role=user_role)
-        print(f"✅ RAG engine returned response successfully")
-
-        # Generate title for new sessions after first message
-        if is_new_session:
-            title = rag_engine.generate_session_title(session_id=session_id)
-            sessions[session_id]["title"] = title
-            
-            # Update session title in database for authenticated users
-            if current_user:
-                try:
-                    update_session_title(db, session_id, title)
-                except Exception as e:
-                    print(f"Warning: Could not update session title in database: {e}")
+    return session_id, session_info, is_new_session, user_role, now_iso
 
-        session_title = sessions[session_id].get("title", "New Conversation")
 
-        return ChatResponse(
-            response=result["response"],
-            session_id=session_id,
-            session_title=session_title,
-            sources=result.get("sources", []),
-            used_retrieval=result.get("used_retrieval", False),
-            timestamp=datetime.now().isoformat()
+def _lookup_cached_answer(message: str, user_role: str, is_new_session: bool):
+    """
+    Look up an opening question in the exact and semantic caches
+    Returns (cached result or None, cache key, query embedding). On a miss the
+    embedding is handed to the RAG engine so retrieval doesn't embed the
+    message again; OpenAI embeddings are unit length, so normalizing it for
+    the cache leaves it usable for the vector store.
+    """
+    if not is_new_session:
+        return None, None, None
+
+    cache_key = SmartResponseCache.make_key(message, user_role)
+    result = response_cache.get(cache_key)
+    query_vector = None
+    if result is None:
+        try:
+            query_vector = semantic_cache.embed(message)
+            result = semantic_cache.lookup(query_vector, user_role)
+        except Exception as e:
+            log.warning("Semantic cache lookup failed: %s", e)
+    return result, cache_key, query_vector
+
+
+def _store_cached_answer(result: Dict[str, Any], user_role: str, cache_key: Optional[str], query_vector) -> None:
+    """Cache a freshly generated answer to an opening question"""
+    if cache_key:
+        response_cache.set(cache_key, result)
+    if query_vector is not None:
+        semantic_cache.store(query_vector, user_role, result)
+
+
+# Opening questions currently being answered, keyed by response-cache key, so
+# concurrent identical questions share one RAG run instead of starting their own
+inflight_answers: Dict[str, asyncio.Future] = {}
+
+
+async def _generate_answer(
+    message: str, session_id: str, user_role: str, cache_key: Optional[str], query_vector
+) -> Dict[str, Any]:
+    """Run the RAG engine for a message, coalescing concurrent identical opening questions"""
+    query_embedding = query_vector.tolist() if query_vector is not None else None
+    if cache_key is None:
+        return await run_in_threadpool(
+            rag_engine.chat, message, session_id=session_id, user_role=user_role, query_embedding=query_embedding
         )
 
+    pending = inflight_answers.get(cache_key)
+    if pending is not None:
+        # Shielded so a cancelled follower doesn't cancel the shared run
+        result = await asyncio.shield(pending)
+        await run_in_threadpool(rag_engine.record_exchange, message, result["response"], session_id=session_id)
+        log.info("⚡ Shared an in-flight chat response")
+        return result
+
+    future = asyncio.get_running_loop().create_future()
+    inflight_answers[cache_key] = future
+    try:
+        result = await run_in_threadpool(
+            rag_engine.chat, message, session_id=session_id, user_role=user_role, query_embedding=query_embedding
+        )
+        _store_cached_answer(result, user_role, cache_key, query_vector)
+        future.set_result(result)
+        return result
     except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"❌ Error in chat endpoint: {str(e)}")
-        print(f"❌ Full traceback:\n{error_trace}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error processing chat request: {str(e)}"
+        future.set_exception(e)
+        future.exception()  # Mark retrieved in case no one else was waiting
+        raise
+    finally:
+        if not future.done():
+            future.cancel()
+        inflight_answers.pop(cache_key, None)
+
+
+async def _finish_chat_turn(session_id: str, session_info: Session, is_new_session: bool) -> str:
+    """Generate a title after a session's first message and return the session title"""
+    if not is_new_session:
+        return session_info.title
+
+    title = await run_in_threadpool(rag_engine.generate_session_title, session_id=session_id)
+    await session_store.update(session_id, title=title)
+    return title
+
+
+async def _persist_session_title(session_id: str, title: str) -> None:
+    """Save a newly generated session title to the database (authenticated sessions only)"""
+    try:
+        await aupdate_session_title(session_id, title)
+    except Exception as e:
+        log.warning("Could not update session title in database: %s", e)
+
+
+def _sse_event(payload: Dict[str, Any]) -> bytes:
+    """Format a payload as a Server-Sent Events data frame"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+# Sent when a stream fails part-way; the details go to the log, not the client
+_STREAM_ERROR_EVENT = _sse_event({"error": "Error processing chat request"})
+
+
+# Streamed tokens are sent in batches that start at one token (fast first
+# paint) and grow geometrically, so long answers cost a few dozen frames and
+# threadpool hops instead of one per token
+STREAM_MIN_BATCH = 1
+STREAM_MAX_BATCH = 50
+STREAM_BATCH_GROWTH = 3
+
+
+def _batch_deltas(events: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Merge consecutive delta events from chat_stream into growing batches"""
+    batch_size = STREAM_MIN_BATCH
+    buffer: List[str] = []
+    for event in events:
+        if event["type"] != "delta":
+            if buffer:
+                yield {"type": "delta", "content": "".join(buffer)}
+                buffer = []
+            yield event
+            continue
+        buffer.append(event["content"])
+        if len(buffer) >= batch_size:
+            yield {"type": "delta", "content": "".join(buffer)}
+            buffer = []
+            batch_size = min(batch_size * STREAM_BATCH_GROWTH, STREAM_MAX_BATCH)
+    if buffer:
+        yield {"type": "delta", "content": "".join(buffer)}
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(
+    request: ChatRequest,
+    background_tasks: BackgroundTasks,
+    current_user: Optional[Dict[str, Any]] = Depends(get_current_user)
+):
+    """
+    Main chat endpoint
+
+    Processes user messages and returns AI responses with source citations
+    Maintains conversation context across messages in the same session
+    For authenticated users, sessions are linked to their account
+    """
+    session_id, session_info, is_new_session, user_role, now_iso = await _begin_chat_turn(request, current_user)
+
+    # Get response from RAG engine with user role
+    log.info("🔄 Processing chat request: session=%s, user_role=%s, authenticated=%s", session_id, user_role, current_user is not None)
+    result, cache_key, query_vector = await run_in_threadpool(
+        _lookup_cached_answer, request.message, user_role, is_new_session
+    )
+    if result is not None:
+        # Keep the session's history consistent with what the user saw
+        await run_in_threadpool(
+            rag_engine.record_exchange, request.message, result["response"], session_id=session_id
         )
+        log.info("⚡ Served chat response from cache")
+    else:
+        result = await _generate_answer(request.message, session_id, user_role, cache_key, query_vector)
+        log.info("✅ RAG engine returned response successfully")
+
+    # Generate title for new sessions after first message
+    session_title = await _finish_chat_turn(session_id, session_info, is_new_session)
+    if is_new_session and current_user:
+        background_tasks.add_task(_persist_session_title, session_id, session_title)
+
+    # Built from our own RAG output, so skip re-validating the sources list
+    return ChatResponse.model_construct(
+        response=result["response"],
+        session_id=session_id,
+        session_title=session_title,
+        sources=result.get("sources", []),
+        used_retrieval=result.get("used_retrieval", False),
+        timestamp=now_iso
+    )
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, current_user: Optional[Dict[str, Any]] = Depends(get_current_user)):
+    """
+    Streaming chat endpoint (Server-Sent Events)
+
+    Sends {"delta": ...} events as the answer is generated, then one final
+    event with the verified response, sources and session details.
+    Behaves like /chat otherwise, which remains available for clients that
+    don't read event streams.
+    """
+    session_id, session_info, is_new_session, user_role, now_iso = await _begin_chat_turn(request, current_user)
+    log.info("🔄 Processing streaming chat request: session=%s, user_role=%s, authenticated=%s", session_id, user_role, current_user is not None)
+
+    async def event_generator():
+        try:
+            result, cache_key, query_vector = await run_in_threadpool(
+                _lookup_cached_answer, request.message, user_role, is_new_session
+            )
+            if result is not None:
+                await run_in_threadpool(
+                    rag_engine.record_exchange, request.message, result["response"], session_id=session_id
+                )
+                yield _sse_event({"delta": result["response"]})
+            else:
+                events = _batch_deltas(rag_engine.chat_stream(
+                    request.message, session_id=session_id, user_role=user_role,
+                    query_embedding=query_vector.tolist() if query_vector is not None else None
+                ))
+                async for event in iterate_in_threadpool(events):
+                    if event["type"] == "delta":
+                        yield _sse_event({"delta": event["content"]})
+                    else:
+                        result = event
+                _store_cached_answer(result, user_role, cache_key, query_vector)
+
+            session_title = await _finish_chat_turn(session_id, session_info, is_new_session)
+            yield _sse_event({
+                "done": True,
+                "response": result["response"],
+                "session_id": session_id,
+                "session_title": session_title,
+                "sources": result.get("sources", []),
+                "used_retrieval": result.get("used_retrieval", False),
+                "timestamp": now_iso
+            })
+
+            # The client already has everything, so the database write comes last
+            if is_new_session and current_user:
+                await _persist_session_title(session_id, session_title)
+        except Exception:
+            log.exception("❌ Error in streaming chat endpoint")
+            yield _STREAM_ERROR_EVENT
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.get("/sessions", response_model=List[SessionInfo])
@@ -769,64 +1107,59 @@ async def list_sessions(current_user: Optional[Dict[str, Any]] = Depends(get_cur
     if not current_user:
         return []  # Empty list for guests - no session history without an account
     
-    db = get_db_session()
     
     # Get ONLY this user's sessions from database
     try:
-        user_sessions = get_user_sessions(db, current_user["id"])
+        user_sessions = await get_user_sessions_async(current_user["id"])
+        stored_info = await session_store.get_many(s.get("session_id") for s in user_sessions)
+        # Fallback for rows missing created_at, computed once rather than per row.
+        # UTC with an offset, like the timestamps database.py stores.
+        now_iso = datetime.now(timezone.utc).isoformat()
         result = []
         for session in user_sessions:
             session_id = session.get("session_id")
-            # Get message count from memory if available
-            memory_info = sessions.get(session_id, {})
+            # Get message count from the session store if available
+            memory_info = stored_info.get(session_id)
+            if memory_info is not None:
+                title = memory_info.title
+                created_at = session.get("created_at") or memory_info.created_at
+                message_count = memory_info.message_count
+                last_activity = session.get("last_activity") or memory_info.last_activity or session.get("created_at")
+            else:
+                title = session.get("title", "New Conversation")
+                created_at = session.get("created_at") or now_iso
+                message_count = 0
+                last_activity = session.get("last_activity") or session.get("created_at")
             result.append(SessionInfo(
                 session_id=session_id,
-                title=memory_info.get("title", session.get("title", "New Conversation")),
-                created_at=session.get("created_at") or memory_info.get("created_at", datetime.utcnow().isoformat()),
-                message_count=memory_info.get("message_count", 0),
-                last_activity=session.get("last_activity") or memory_info.get("last_activity", session.get("created_at"))
+                title=title,
+                created_at=created_at,
+                message_count=message_count,
+                last_activity=last_activity
             ))
         return result
     except Exception as e:
-        print(f"Error fetching user sessions: {e}")
+        log.error("Error fetching user sessions: %s", e)
         return []  # Return empty on error for safety
 
 
 @app.get("/sessions/{session_id}", response_model=SessionInfo)
 async def get_session(session_id: str, current_user: Optional[Dict[str, Any]] = Depends(get_current_user)):
     """Get information about a specific session (with ownership verification)"""
-    db = get_db_session()
     user_id = current_user["id"] if current_user else None
     
-    # SECURITY: Check in-memory ownership first
-    if session_id in sessions:
-        session_owner_id = sessions[session_id].get("owner_id")
-        if session_owner_id and session_owner_id != user_id:
-            raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
-    
-    # Also check database ownership
-    if current_user:
-        if not verify_session_ownership(db, session_id, user_id):
-            # Check if session exists in DB but belongs to someone else
-            db_owner = get_session_owner(db, session_id)
-            if db_owner and db_owner != user_id:
-                raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
-    else:
-        # Guest - deny access if session has any owner
-        session_owner = get_session_owner(db, session_id)
-        if session_owner:
-            raise HTTPException(status_code=403, detail="Access denied: This session belongs to another user")
-    
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+    # SECURITY: Verify session ownership
+    session_info = await _authorize_session(session_id, user_id)
+    if not session_info:
+        raise SessionNotFound(session_id)
 
-    info = sessions[session_id]
+    info = session_info
     return SessionInfo(
         session_id=session_id,
-        title=info.get("title", "New Conversation"),
-        created_at=info["created_at"],
-        message_count=info["message_count"],
-        last_activity=info.get("last_activity", info["created_at"])
+        title=info.title,
+        created_at=info.created_at,
+        message_count=info.message_count,
+        last_activity=info.last_activity or info.created_at
     )
 
 
@@ -839,112 +1172,58 @@ async def get_conversation_history(session_id: str, current_user: Optional[Dict[
             detail="RAG engine not initialized"
         )
     
-    db = get_db_session()
     user_id = current_user["id"] if current_user else None
     
-    # SECURITY: Check in-memory ownership first
-    if session_id in sessions:
-        session_owner_id = sessions[session_id].get("owner_id")
-        if session_owner_id and session_owner_id != user_id:
-            raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
-    
-    # Also check database ownership
-    if current_user:
-        db_owner = get_session_owner(db, session_id)
-        if db_owner and db_owner != user_id:
-            raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
-    else:
-        # Guest - deny access if session has any owner
-        session_owner = get_session_owner(db, session_id)
-        if session_owner:
-            raise HTTPException(status_code=403, detail="Access denied: This session belongs to another user")
-
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    try:
-        messages = rag_engine.get_conversation_history(session_id=session_id)
-        info = sessions[session_id]
+    # SECURITY: Verify session ownership
+    session_info = await _authorize_session(session_id, user_id)
+    if not session_info:
+        raise SessionNotFound(session_id)
 
-        return ConversationHistory(
-            session_id=session_id,
-            messages=messages,
-            created_at=info["created_at"],
-            message_count=info["message_count"],
-            last_activity=info.get("last_activity", 
-            info["created_at"])
-        )
+    messages = await run_in_threadpool(rag_engine.get_conversation_history, session_id=session_id)
+    info = session_info
 
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error retrieving conversation history: {str(e)}"
-        )
+    return ConversationHistory(
+        session_id=session_id,
+        messages=messages,
+        created_at=info.created_at,
+        message_count=info.message_count,
+        last_activity=info.last_activity or info.created_at
+    )
 
 
 @app.delete("/sessions/{session_id}")
-async def delete_session(session_id: str, current_user: Optional[Dict[str, Any]] = Depends(get_current_user)):
+async def delete_session(session_id: str, current_user: Optional[Dict[str, Any]] = Depends(get_current_user)) -> Dict[str, Any]:
     """Delete a session and its conversation history (with ownership verification)"""
-    db = get_db_session()
     user_id = current_user["id"] if current_user else None
     
-    # SECURITY: Check in-memory ownership first
-    if session_id in sessions:
-        session_owner_id = sessions[session_id].get("owner_id")
-        if session_owner_id and session_owner_id != user_id:
-            raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
-    
-    # Check database ownership and delete if authenticated
+    # SECURITY: Verify session ownership (guests may only delete unowned sessions)
+    session_info = await _authorize_session(session_id, user_id)
     if current_user:
-        db_owner = get_session_owner(db, session_id)
-        if db_owner and db_owner != user_id:
-            raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
         # Delete from database
-        delete_user_session(db, session_id, user_id)
-    else:
-        # For guests, only allow deletion of sessions not owned by anyone
-        session_owner = get_session_owner(db, session_id)
-        if session_owner:
-            raise HTTPException(status_code=403, detail="Access denied: This session belongs to another user")
+        await adelete_user_session(session_id, user_id)
     
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+    if not session_info:
+        raise SessionNotFound(session_id)
 
     # Remove from sessions storage
-    del sessions[session_id]
+    await session_store.delete(session_id)
 
     return {"message": f"Session {session_id} deleted successfully"}
 
 
 @app.post("/sessions/{session_id}/clear")
-async def clear_session_history(session_id: str, current_user: Optional[Dict[str, Any]] = Depends(get_current_user)):
+async def clear_session_history(session_id: str, current_user: Optional[Dict[str, Any]] = Depends(get_current_user)) -> Dict[str, Any]:
     """Clear conversation history for a session while keeping the session active (with ownership verification)"""
-    db = get_db_session()
     user_id = current_user["id"] if current_user else None
     
-    # SECURITY: Check in-memory ownership first
-    if session_id in sessions:
-        session_owner_id = sessions[session_id].get("owner_id")
-        if session_owner_id and session_owner_id != user_id:
-            raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
-    
-    # Also check database ownership
-    if current_user:
-        db_owner = get_session_owner(db, session_id)
-        if db_owner and db_owner != user_id:
-            raise HTTPException(status_code=403, detail="Access denied: This session does not belong to you")
-    else:
-        # For guests, only allow clearing of sessions not owned by anyone
-        session_owner = get_session_owner(db, session_id)
-        if session_owner:
-            raise HTTPException(status_code=403, detail="Access denied: This session belongs to another user")
-    
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+    # SECURITY: Verify session ownership (guests may only clear unowned sessions)
+    session_info = await _authorize_session(session_id, user_id)
+    if not session_info:
+        raise SessionNotFound(session_id)
 
     # Reset message count (session metadata) but note this does not clear LangGraph memory
-    sessions[session_id]["message_count"] = 0
-    sessions[session_id]["last_activity"] = datetime.now().isoformat()
+    now_iso = datetime.now().isoformat()
+    await session_store.update(session_id, message_count=0, last_activity=now_iso)
 
     # Note: LangGraph's MemorySaver doesn't have a direct clear method
     # In production, you'd want to implement a custom checkpointer with clear functionality
@@ -958,7 +1237,7 @@ async def clear_session_history(session_id: str, current_user: Optional[Dict[str
 
 
 @app.post("/feedback")
-async def submit_feedback(request: FeedbackRequest):
+async def submit_feedback(request: FeedbackRequest) -> Dict[str, Any]:
     """
     Submit feedback for an AI response
     
@@ -983,26 +1262,11 @@ async def submit_feedback(request: FeedbackRequest):
         "timestamp": datetime.now().isoformat()
     }
     
-    # Store feedback
-    if request.session_id not in feedback_store:
-        feedback_store[request.session_id] = []
-    
-    # Check if feedback already exists for this message
-    existing_idx = next(
-        (i for i, f in enumerate(feedback_store[request.session_id]) 
-         if f["message_index"] == request.message_index),
-        None
-    )
-    
-    if existing_idx is not None:
-        # Update existing feedback
-        feedback_store[request.session_id][existing_idx] = feedback_entry
-    else:
-        # Add new feedback
-        feedback_store[request.session_id].append(feedback_entry)
+    # Store feedback (replaces any earlier feedback for this message)
+    await feedback_store.put(feedback_entry)
     
     # Log feedback for monitoring
-    print(f"📊 Feedback received: {request.feedback_type} for session {request.session_id[:8]}... message #{request.message_index}")
+    log.info("📊 Feedback received: %s for session %s... message #%s", request.feedback_type, request.session_id[:8], request.message_index)
     
     return {
         "status": "success",
@@ -1012,50 +1276,39 @@ async def submit_feedback(request: FeedbackRequest):
     }
 
 
+_FEEDBACK_REMOVED_RESPONSE = Response(
+    content=orjson.dumps({"status": "success", "message": "Feedback removed successfully"}),
+    media_type="application/json"
+)
+
+
 @app.delete("/feedback/{session_id}/{message_index}")
 async def remove_feedback(session_id: str, message_index: int):
     """Remove feedback for a specific message"""
-    if session_id not in feedback_store:
-        raise HTTPException(status_code=404, detail="No feedback found for this session")
-    
     # Find and remove feedback
-    feedback_list = feedback_store[session_id]
-    original_len = len(feedback_list)
-    feedback_store[session_id] = [f for f in feedback_list if f["message_index"] != message_index]
+    removed = await feedback_store.remove(session_id, message_index)
+    if removed is None:
+        raise HTTPException(status_code=404, detail="No feedback found for this session")
     
-    if len(feedback_store[session_id]) == original_len:
+    if not removed:
         raise HTTPException(status_code=404, detail="Feedback not found for this message")
     
-    return {
-        "status": "success",
-        "message": "Feedback removed successfully"
-    }
+    return _FEEDBACK_REMOVED_RESPONSE
 
 
 @app.get("/feedback/{session_id}")
-async def get_session_feedback(session_id: str):
+async def get_session_feedback(session_id: str) -> Dict[str, Any]:
     """Get all feedback for a session"""
-    if session_id not in feedback_store:
-        return {"session_id": session_id, "feedback": []}
-    
-    return {
-        "session_id": session_id,
-        "feedback": feedback_store[session_id]
-    }
+    session_feedback = await feedback_store.get(session_id)
+    return {"session_id": session_id, "feedback": session_feedback or []}
 
 
 @app.get("/feedback/stats/summary")
-async def get_feedback_stats():
+async def get_feedback_stats() -> Dict[str, Any]:
     """Get overall feedback statistics"""
-    total_liked = 0
-    total_disliked = 0
-    
-    for session_feedback in feedback_store.values():
-        for f in session_feedback:
-            if f["feedback_type"] == "liked":
-                total_liked += 1
-            else:
-                total_disliked += 1
+    stats = await feedback_store.stats()
+    total_liked = stats["liked"]
+    total_disliked = stats["disliked"]
     
     total = total_liked + total_disliked
     
@@ -1064,7 +1317,7 @@ async def get_feedback_stats():
         "liked": total_liked,
         "disliked": total_disliked,
         "satisfaction_rate": round(total_liked / total * 100, 1) if total > 0 else None,
-        "sessions_with_feedback": len(feedback_store)
+        "sessions_with_feedback": stats["sessions"]
     }
 
 
@@ -1081,33 +1334,24 @@ async def regenerate_response(request: RegenerateRequest, current_user: Optional
             detail="RAG engine not initialized. Please try again later."
         )
     
-    db = get_db_session()
     
     # SECURITY: Verify session ownership
-    session_owner = get_session_owner(db, request.session_id)
-    if session_owner:
-        if current_user:
-            if session_owner != current_user["id"]:
-                raise HTTPException(
-                    status_code=403, 
-                    detail="Access denied: This conversation belongs to another user"
-                )
-        else:
-            raise HTTPException(
-                status_code=403, 
-                detail="Access denied: This conversation belongs to another user"
-            )
-    
-    if request.session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+    session_info = await _authorize_session(
+        request.session_id,
+        current_user["id"] if current_user else None,
+        "Access denied: This conversation belongs to another user"
+    )
+    if not session_info:
+        raise SessionNotFound(request.session_id)
     
     # Validate user role
-    valid_roles = ["tax_lawyer", "taxpayer", "company"]
-    user_role = request.user_role if request.user_role in valid_roles else "taxpayer"
+    user_role = request.user_role if request.user_role in VALID_ROLES else "taxpayer"
     
-    try:
-        # Get conversation history
-        messages = rag_engine.get_conversation_history(session_id=request.session_id)
+    # Recorded on every chat turn; sessions from before that was tracked
+    # fall back to scanning the conversation history
+    last_human_msg = session_info.last_user_message
+    if not last_human_msg:
+        messages = await run_in_threadpool(rag_engine.get_conversation_history, session_id=request.session_id)
         
         if not messages or len(messages) < 2:
             raise HTTPException(
@@ -1116,46 +1360,40 @@ async def regenerate_response(request: RegenerateRequest, current_user: Optional
             )
         
         # Find the last human message
-        last_human_msg = None
         for msg in reversed(messages):
             if msg.get("role") == "human":
                 last_human_msg = msg.get("content")
                 break
-        
-        if not last_human_msg:
-            raise HTTPException(
-                status_code=400,
-                detail="No user message found to regenerate response for"
-            )
-        
-        # Generate new response with the same message
-        result = rag_engine.chat(last_human_msg, session_id=request.session_id, user_role=user_role)
-        
-        session_title = sessions[request.session_id].get("title", "New Conversation")
-        sessions[request.session_id]["last_activity"] = datetime.now().isoformat()
-        
-        print(f"🔄 Response regenerated for session {request.session_id[:8]}...")
-        
-        return ChatResponse(
-            response=result["response"],
-            session_id=request.session_id,
-            session_title=session_title,
-            sources=result.get("sources", []),
-            used_retrieval=result.get("used_retrieval", False),
-            timestamp=datetime.now().isoformat()
-        )
-        
-    except HTTPException:
-        raise
-    except Exception as e:
+    
+    if not last_human_msg:
         raise HTTPException(
-            status_code=500,
-            detail=f"Error regenerating response: {str(e)}"
+            status_code=400,
+            detail="No user message found to regenerate response for"
         )
+    
+    # Generate new response with the same message
+    result = await run_in_threadpool(
+        rag_engine.chat, last_human_msg, session_id=request.session_id, user_role=user_role, regenerate=True
+    )
+    
+    session_title = session_info.title
+    now_iso = datetime.now().isoformat()
+    await session_store.update(request.session_id, last_activity=now_iso)
+    
+    log.info("🔄 Response regenerated for session %s...", request.session_id[:8])
+    
+    return ChatResponse.model_construct(
+        response=result["response"],
+        session_id=request.session_id,
+        session_title=session_title,
+        sources=result.get("sources", []),
+        used_retrieval=result.get("used_retrieval", False),
+        timestamp=now_iso
+    )
 
 
 @app.post("/reload-documents")
-async def reload_documents():
+async def reload_documents() -> Dict[str, Any]:
     """
     Reload policy documents and rebuild vector database
     Use this endpoint when documents are updated
@@ -1166,29 +1404,18 @@ async def reload_documents():
             detail="RAG engine not initialized"
         )
 
-    try:
-        print("🔄 Starting document reload...")
-        rag_engine.create_vector_database(force_reload=True)
-        print("✅ Documents reloaded successfully")
-        return {
-            "message": "Documents reloaded and vector database rebuilt successfully",
-            "timestamp": datetime.now().isoformat()
-        }
-
-    except ValueError as e:
-        print(f"❌ ValueError during reload: {str(e)}")
-        raise HTTPException(
-            status_code=400,
-            detail=f"Document loading error: {str(e)}"
-        )
-    except Exception as e:
-        print(f"❌ Exception during reload: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error reloading documents: {str(e)}"
-        )
+    log.info("🔄 Starting document reload...")
+    await run_in_threadpool(rag_engine.create_vector_database, force_reload=True)
+    # Cached answers were built from the old vector database
+    response_cache.clear()
+    semantic_cache.clear()
+    global _docs_listing
+    _docs_listing = None
+    log.info("✅ Documents reloaded successfully")
+    return {
+        "message": "Documents reloaded and vector database rebuilt successfully",
+        "timestamp": datetime.now().isoformat()
+    }
 
 
 class TTSRequest(BaseModel):
@@ -1199,6 +1426,8 @@ class TTSRequest(BaseModel):
 
 # OpenAI TTS voices
 OPENAI_VOICES = ["alloy", "echo", "fable", "onyx", "nova", "shimmer"]
+# Large enough to keep write syscalls low, small enough that playback starts early
+TTS_CHUNK_SIZE = 64 * 1024
 
 
 @app.post("/tts")
@@ -1213,6 +1442,7 @@ async def text_to_speech(request: TTSRequest):
             detail="Text cannot be empty"
         )
     
+    upstream = AsyncExitStack()
     try:
         # Validate voice
         voice = request.voice.lower() if request.voice.lower() in OPENAI_VOICES else "alloy"
@@ -1220,62 +1450,92 @@ async def text_to_speech(request: TTSRequest):
         # Limit text length to prevent excessive API usage
         text_to_speak = request.text[:4096].strip()
         
-        print(f"🎙️ Generating TTS with OpenAI voice '{voice}' for {len(text_to_speak)} chars")
+        log.info("🎙️ Generating TTS with OpenAI voice '%s' for %s chars", voice, len(text_to_speak))
         
-        # Generate speech using OpenAI
-        response = openai_client.audio.speech.create(
-            model="tts-1",
-            voice=voice,
-            input=text_to_speak
+        # Open the synthesis as a stream so audio is forwarded as it is produced.
+        # The stream outlives this handler. The generator closes it once the body
+        # is sent, and the background task covers responses that never start it;
+        # closing twice is a no-op.
+        response = await upstream.enter_async_context(
+            openai_client.audio.speech.with_streaming_response.create(
+                model="tts-1",
+                voice=voice,
+                input=text_to_speak,
+                response_format="mp3"
+            )
         )
-        
-        # Get audio data
-        audio_data = response.content
-        
+
+        async def stream_audio():
+            try:
+                async for chunk in response.iter_bytes(chunk_size=TTS_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                await upstream.aclose()
+
         return StreamingResponse(
-            iter([audio_data]),
+            stream_audio(),
             media_type="audio/mpeg",
             headers={
                 "Content-Disposition": "inline; filename=speech.mp3",
                 "Access-Control-Allow-Origin": "*",
                 "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
                 "Access-Control-Allow-Headers": "Content-Type"
-            }
+            },
+            background=BackgroundTask(upstream.aclose)
         )
             
     except Exception as e:
-        print(f"TTS Error: {str(e)}")
+        await upstream.aclose()
+        log.error("TTS Error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Error generating speech: {str(e)}"
         )
         
+# Resolved once so serving a document only resolves the requested path
+DOCS_DIR = (Path(__file__).parent / "rag" / "docs").resolve()
+
+# (directory mtime_ns, listing) — adding, removing or renaming a PDF bumps the
+# directory mtime, so the scan only reruns when the folder actually changed
+_docs_listing: Optional[tuple] = None
+
+# Not immutable: /reload-documents may swap a PDF in place, and the ETag lets
+# browsers revalidate with a bodyless 304 once this expires
+DOCUMENT_CACHE_CONTROL = "public, max-age=3600"
+
+
 @app.get("/documents")
-async def list_documents():
+async def list_documents() -> Dict[str, Any]:
     """
     List all available PDF documents
     Returns document names and their URLs for linking
     """
-    docs_dir = Path(__file__).parent / "rag" / "docs"
-    
-    if not docs_dir.exists():
+    global _docs_listing
+
+    try:
+        mtime = DOCS_DIR.stat().st_mtime_ns
+    except FileNotFoundError:
         return {"documents": []}
-    
-    documents = []
-    for pdf_file in docs_dir.glob("*.pdf"):
-        # Create URL-safe filename
-        safe_name = pdf_file.name.replace(" ", "%20")
-        documents.append({
+
+    if _docs_listing is not None and _docs_listing[0] == mtime:
+        return {"documents": _docs_listing[1]}
+
+    documents = [
+        {
             "filename": pdf_file.name,
             "display_name": pdf_file.stem,
-            "url": f"/documents/{safe_name}"
-        })
-    
+            "url": f"/documents/{quote(pdf_file.name, safe='')}"
+        }
+        for pdf_file in DOCS_DIR.iterdir()
+        if pdf_file.suffix.lower() == ".pdf"
+    ]
+
+    _docs_listing = (mtime, documents)
     return {"documents": documents}
 
 
 @app.get("/documents/{filename:path}")
-async def serve_document(filename: str, page: int = None):
+async def serve_document(request: Request, filename: str, page: int = None):
     """
     Serve a PDF document by filename
     
@@ -1287,42 +1547,55 @@ async def serve_document(filename: str, page: int = None):
         The PDF file with appropriate headers for inline viewing
     """
     # Decode URL-encoded filename
-    from urllib.parse import unquote
     decoded_filename = unquote(filename)
     
-    docs_dir = Path(__file__).parent / "rag" / "docs"
-    file_path = docs_dir / decoded_filename
-    
     # Security: ensure the file is within docs directory
     try:
-        file_path = file_path.resolve()
-        docs_dir = docs_dir.resolve()
-        if not str(file_path).startswith(str(docs_dir)):
-            raise HTTPException(status_code=403, detail="Access denied")
+        file_path = (DOCS_DIR / decoded_filename).resolve()
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid filename")
+    if not file_path.is_relative_to(DOCS_DIR):
+        raise HTTPException(status_code=403, detail="Access denied")
     
-    if not file_path.exists():
+    try:
+        stat_result = file_path.stat()
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail=f"Document not found: {decoded_filename}")
     
     if not file_path.suffix.lower() == ".pdf":
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
     
+    # Documents only change on reload, so size + mtime identify a version
+    etag = f'W/"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+    cache_headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": DOCUMENT_CACHE_CONTROL,
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=cache_headers)
+    
     # Return PDF with inline disposition for browser viewing
     return FileResponse(
         path=str(file_path),
         media_type="application/pdf",
         filename=decoded_filename,
+        stat_result=stat_result,
         headers={
             "Content-Disposition": f"inline; filename=\"{decoded_filename}\"",
             "Access-Control-Allow-Origin": "*",
+            **cache_headers,
         }
     )
 
 
+# Built once; load balancers poll this constantly
+_HEALTHCHECK_RESPONSE = Response(content=orjson.dumps({"status": "ok"}), media_type="application/json")
+
+
 @app.get("/healthcheck")
 async def healthcheck():
-    return {"status": "ok"}
+    return _HEALTHCHECK_RESPONSE
 
 
 # =============================================
@@ -1346,8 +1619,19 @@ class DonationResponse(BaseModel):
     reference: Optional[str] = None
 
 
-# Store donations (in production, use a database)
-donations_store: Dict[str, Dict[str, Any]] = {}
+# Fixed for the life of the process, so serialized once at import
+_DONATION_CONFIG_BODY = orjson.dumps({
+    "public_key": PAYSTACK_PUBLIC_KEY,
+    "currency": "NGN",
+    "coffee_prices": [
+        {"label": "☕ 1 Coffee", "amount": 1000, "description": "Buy me a coffee!"},
+        {"label": "☕☕ 2 Coffees", "amount": 2000, "description": "Extra caffeine boost!"},
+        {"label": "☕☕☕ 3 Coffees", "amount": 3000, "description": "You're amazing!"},
+        {"label": "🎉 Custom", "amount": None, "description": "Choose your amount"},
+    ],
+    "recipient_name": "Nigerian Tax AI Assistant Team",
+    "thank_you_message": "Thank you for supporting the Nigerian Tax AI Assistant! Your contribution helps us keep improving."
+})
 
 
 @app.get("/donate/config")
@@ -1355,18 +1639,7 @@ async def get_donation_config():
     """
     Get Paystack public key and donation options for frontend
     """
-    return {
-        "public_key": PAYSTACK_PUBLIC_KEY,
-        "currency": "NGN",
-        "coffee_prices": [
-            {"label": "☕ 1 Coffee", "amount": 1000, "description": "Buy me a coffee!"},
-            {"label": "☕☕ 2 Coffees", "amount": 2000, "description": "Extra caffeine boost!"},
-            {"label": "☕☕☕ 3 Coffees", "amount": 3000, "description": "You're amazing!"},
-            {"label": "🎉 Custom", "amount": None, "description": "Choose your amount"},
-        ],
-        "recipient_name": "Nigerian Tax AI Assistant Team",
-        "thank_you_message": "Thank you for supporting the Nigerian Tax AI Assistant! Your contribution helps us keep improving."
-    }
+    return Response(content=_DONATION_CONFIG_BODY, media_type="application/json")
 
 
 @app.post("/donate/initialize", response_model=DonationResponse)
@@ -1384,7 +1657,7 @@ async def initialize_donation(request: DonationRequest):
         )
     
     # Generate unique reference
-    reference = f"coffee_{uuid.uuid4().hex[:12]}"
+    reference = f"coffee_{secrets.token_hex(6)}"
     
     # Convert Naira to Kobo (Paystack uses kobo)
     amount_in_kobo = request.amount * 100
@@ -1410,50 +1683,46 @@ async def initialize_donation(request: DonationRequest):
     
     # Initialize transaction with Paystack
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{PAYSTACK_BASE_URL}/transaction/initialize",
-                headers={
-                    "Authorization": f"Bearer {PAYSTACK_SECRET_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "email": request.email,
-                    "amount": amount_in_kobo,
-                    "reference": reference,
-                    "currency": "NGN",
-                    "metadata": metadata,
-                    "callback_url": os.getenv("PAYSTACK_CALLBACK_URL", "http://localhost:5173/donate/callback")
-                }
-            )
+        response = await paystack_client.post(
+            "/transaction/initialize",
+            json={
+                "email": request.email,
+                "amount": amount_in_kobo,
+                "reference": reference,
+                "currency": "NGN",
+                "metadata": metadata,
+                "callback_url": os.getenv("PAYSTACK_CALLBACK_URL", "http://localhost:5173/donate/callback")
+            }
+        )
+        
+        result = response.json()
+        
+        if result.get("status"):
+            # Store donation info
+            await donation_store.save({
+                "reference": reference,
+                "email": request.email,
+                "amount": request.amount,
+                "name": request.name,
+                "message": request.message,
+                "status": "pending",
+                "created_at": datetime.now().isoformat()
+            })
             
-            result = response.json()
+            log.info("☕ Donation initialized: %s - ₦%s from %s", reference, request.amount, request.email)
             
-            if result.get("status"):
-                # Store donation info
-                donations_store[reference] = {
-                    "email": request.email,
-                    "amount": request.amount,
-                    "name": request.name,
-                    "message": request.message,
-                    "status": "pending",
-                    "created_at": datetime.now().isoformat()
-                }
-                
-                print(f"☕ Donation initialized: {reference} - ₦{request.amount} from {request.email}")
-                
-                return DonationResponse(
-                    status=True,
-                    message="Payment initialized successfully",
-                    authorization_url=result["data"]["authorization_url"],
-                    access_code=result["data"]["access_code"],
-                    reference=reference
-                )
-            else:
-                raise HTTPException(
-                    status_code=400,
-                    detail=result.get("message", "Failed to initialize payment")
-                )
+            return DonationResponse(
+                status=True,
+                message="Payment initialized successfully",
+                authorization_url=result["data"]["authorization_url"],
+                access_code=result["data"]["access_code"],
+                reference=reference
+            )
+        else:
+            raise HTTPException(
+                status_code=400,
+                detail=result.get("message", "Failed to initialize payment")
+            )
                 
     except httpx.RequestError as e:
         raise HTTPException(
@@ -1463,7 +1732,7 @@ async def initialize_donation(request: DonationRequest):
 
 
 @app.api_route("/donate/verify/{reference}", methods=["GET", "POST"])
-async def verify_donation(reference: str, request: Request):
+async def verify_donation(reference: str, request: Request) -> Dict[str, Any]:
     """
     Verify a donation payment status
     
@@ -1488,67 +1757,62 @@ async def verify_donation(reference: str, request: Request):
         pass
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{PAYSTACK_BASE_URL}/transaction/verify/{reference}",
-                headers={
-                    "Authorization": f"Bearer {PAYSTACK_SECRET_KEY}"
-                }
-            )
+        response = await paystack_client.get(f"/transaction/verify/{reference}")
+        
+        result = response.json()
+        
+        if result.get("status") and result.get("data"):
+            data = result["data"]
+            payment_status = data.get("status")
+            amount = data.get("amount", 0) // 100  # Convert kobo back to Naira
+            donor_email = (data.get("customer") or {}).get("email")
+            paid_at = data.get("paid_at")
             
-            result = response.json()
+            # Update or create stored donation
+            payment_data = {
+                "gateway_response": data.get("gateway_response"),
+                "channel": data.get("channel"),
+                "paid_at": paid_at
+            }
+            now_iso = datetime.now().isoformat()
+            updated = await donation_store.update(
+                reference, status=payment_status, verified_at=now_iso, payment_data=payment_data
+            )
+            if not updated:
+                # For inline payments, create the donation record now
+                await donation_store.save({
+                    "reference": reference,
+                    "email": donor_email,
+                    "amount": amount,
+                    "name": donor_name,
+                    "message": donor_message,
+                    "status": payment_status,
+                    "created_at": now_iso,
+                    "verified_at": now_iso,
+                    "payment_data": payment_data
+                })
             
-            if result.get("status") and result.get("data"):
-                data = result["data"]
-                payment_status = data.get("status")
-                
-                # Update or create stored donation
-                if reference in donations_store:
-                    donations_store[reference]["status"] = payment_status
-                    donations_store[reference]["verified_at"] = datetime.now().isoformat()
-                    donations_store[reference]["payment_data"] = {
-                        "gateway_response": data.get("gateway_response"),
-                        "channel": data.get("channel"),
-                        "paid_at": data.get("paid_at")
-                    }
-                else:
-                    # For inline payments, create the donation record now
-                    donations_store[reference] = {
-                        "email": data.get("customer", {}).get("email"),
-                        "amount": data.get("amount", 0) // 100,
-                        "name": donor_name,
-                        "message": donor_message,
-                        "status": payment_status,
-                        "created_at": datetime.now().isoformat(),
-                        "verified_at": datetime.now().isoformat(),
-                        "payment_data": {
-                            "gateway_response": data.get("gateway_response"),
-                            "channel": data.get("channel"),
-                            "paid_at": data.get("paid_at")
-                        }
-                    }
-                
-                if payment_status == "success":
-                    print(f"☕ Donation successful: {reference} - ₦{data.get('amount', 0) // 100}")
-                    return {
-                        "status": "success",
-                        "message": "Thank you for your donation! ☕",
-                        "amount": data.get("amount", 0) // 100,  # Convert back to Naira
-                        "reference": reference,
-                        "paid_at": data.get("paid_at"),
-                        "donor_email": data.get("customer", {}).get("email")
-                    }
-                else:
-                    return {
-                        "status": payment_status,
-                        "message": f"Payment {payment_status}",
-                        "reference": reference
-                    }
+            if payment_status == "success":
+                log.info("☕ Donation successful: %s - ₦%s", reference, amount)
+                return {
+                    "status": "success",
+                    "message": "Thank you for your donation! ☕",
+                    "amount": amount,
+                    "reference": reference,
+                    "paid_at": paid_at,
+                    "donor_email": donor_email
+                }
             else:
-                raise HTTPException(
-                    status_code=404,
-                    detail="Transaction not found"
-                )
+                return {
+                    "status": payment_status,
+                    "message": f"Payment {payment_status}",
+                    "reference": reference
+                }
+        else:
+            raise HTTPException(
+                status_code=404,
+                detail="Transaction not found"
+            )
                 
     except httpx.RequestError as e:
         raise HTTPException(
@@ -1565,11 +1829,18 @@ async def paystack_webhook(request: Request):
     Configure this URL in your Paystack dashboard to receive
     real-time payment notifications.
     """
-    # Verify webhook signature (in production, verify the signature)
-    # signature = request.headers.get("x-paystack-signature")
+    # Paystack signs the raw body with HMAC-SHA512 keyed by the secret key;
+    # anything else is rejected before the body is parsed
+    if not PAYSTACK_SECRET_KEY:
+        return Response(status_code=503)
+    raw_body = await request.body()
+    signature = request.headers.get("x-paystack-signature", "").encode()
+    expected = hmac.new(PAYSTACK_SECRET_KEY.encode(), raw_body, hashlib.sha512).hexdigest().encode()
+    if not hmac.compare_digest(signature, expected):
+        return Response(status_code=401)
     
     try:
-        payload = await request.json()
+        payload = orjson.loads(raw_body)
         event = payload.get("event")
         data = payload.get("data", {})
         
@@ -1579,32 +1850,29 @@ async def paystack_webhook(request: Request):
             email = data.get("customer", {}).get("email")
             
             # Update donation status
-            if reference in donations_store:
-                donations_store[reference]["status"] = "success"
-                donations_store[reference]["webhook_received"] = datetime.now().isoformat()
+            await donation_store.update(
+                reference, status="success", webhook_received=datetime.now().isoformat()
+            )
             
-            print(f"☕ Webhook: Donation received - {reference} - ₦{amount} from {email}")
+            log.info("☕ Webhook: Donation received - %s - ₦%s from %s", reference, amount, email)
             
         return {"status": "ok"}
         
     except Exception as e:
-        print(f"Webhook error: {e}")
+        log.error("Webhook error: %s", e)
         return {"status": "error", "message": str(e)}
 
 
 @app.get("/donate/stats")
-async def get_donation_stats():
+async def get_donation_stats() -> Dict[str, Any]:
     """
     Get donation statistics (public endpoint for transparency)
     """
-    successful_donations = [d for d in donations_store.values() if d.get("status") == "success"]
-    
-    total_amount = sum(d.get("amount", 0) for d in successful_donations)
-    total_count = len(successful_donations)
+    total_count, total_amount, recent_donations = await donation_store.stats(recent=5)
     
     # Get recent donors (anonymized)
     recent_donors = []
-    for d in sorted(successful_donations, key=lambda x: x.get("created_at", ""), reverse=True)[:5]:
+    for d in recent_donations:
         recent_donors.append({
             "name": d.get("name", "Anonymous") or "Anonymous",
             "amount": d.get("amount", 0),
@@ -1623,26 +1891,89 @@ async def get_donation_stats():
 
 
 # Exception handlers
+_SESSION_NOT_FOUND_BODY = orjson.dumps({"detail": "Session not found"})
+
+
+@app.exception_handler(SessionNotFound)
+async def session_not_found_handler(request: Request, exc: SessionNotFound):
+    """Unknown or expired session ids"""
+    return Response(content=_SESSION_NOT_FOUND_BODY, status_code=404, media_type="application/json")
+
+
+@app.exception_handler(DocumentLoadError)
+async def document_load_error_handler(request: Request, exc: DocumentLoadError):
+    """Missing or unreadable policy documents"""
+    log.error("❌ Document loading error: %s", exc)
+    return JSONResponse(status_code=400, content={"detail": f"Document loading error: {exc}"})
+
+
+# Same body for every unexpected error: details go to the log, not the client
+_INTERNAL_ERROR_BODY = orjson.dumps({"detail": "Internal server error"})
+
+
+@app.exception_handler(RAGEngineError)
+async def rag_engine_error_handler(request: Request, exc: RAGEngineError):
+    """Failures inside the RAG engine (LLM, retrieval or agent errors)"""
+    log.error("❌ RAG engine error on %s: %s", request.url.path, exc, exc_info=exc)
+    return Response(content=_INTERNAL_ERROR_BODY, status_code=500, media_type="application/json")
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Global exception handler"""
-    return JSONResponse(
-        status_code=500,
-        content={
-            "detail": f"Internal server error: {str(exc)}",
-            "path": str(request.url)
-        }
-    )
+    log.error("❌ Unhandled error on %s %s", request.method, request.url.path, exc_info=exc)
+    return Response(content=_INTERNAL_ERROR_BODY, status_code=500, media_type="application/json")
+
+
+# =============================================
+# FRONTEND STATIC FILES
+# =============================================
+
+FRONTEND_DIST_DIR = backend_dir.parent / "frontend" / "dist"
+# Where to serve the built frontend, e.g. "/static". Must match the VITE_BASE
+# the build was made with; unset means the frontend is hosted elsewhere.
+FRONTEND_BASE_PATH = os.getenv("FRONTEND_BASE_PATH", "").rstrip("/")
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers keep content-hashed build assets forever"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        # Vite writes every bundle under assets/ with a content hash in its name
+        if Path(self.get_path(scope)).parts[:1] == ("assets",):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            # index.html points at the current hashes, so always revalidate it
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
+if FRONTEND_BASE_PATH and FRONTEND_DIST_DIR.is_dir():
+    app.mount(FRONTEND_BASE_PATH, CachedStaticFiles(directory=FRONTEND_DIST_DIR, html=True), name="frontend")
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    # Run the server
+    # One worker by default: conversation history lives in the RAG engine's
+    # in-process MemorySaver, so a follow-up turn, /regenerate or history
+    # request landing on another worker would see an empty thread. Only raise
+    # WEB_CONCURRENCY once the LangGraph checkpointer is shared (e.g. a Postgres
+    # or Redis saver), sessions live in Redis (REDIS_URL) and every process
+    # signs tokens with the same JWT_SECRET.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # DEV=1 restores hot reload, which uvicorn only supports with one process
+    dev = os.getenv("DEV") == "1"
+
+    # Run the server ("auto" picks uvloop and httptools when installed)
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        workers=1 if dev else workers,
+        loop="auto",
+        http="auto",
+        reload=dev,
         log_level="info"
     )
@@ -0,0 +1,118 @@
+"""
+Persistent embedding cache
+Stores document embeddings in SQLite keyed by (model name, SHA-256 of the
+text) so unchanged chunks are never re-embedded across reloads or restarts.
+Query vectors only go in a bounded in-memory LRU, since user questions are
+unbounded and rarely worth keeping on disk
+"""
+
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from typing import List, Dict, Optional
+
+import numpy as np
+from cachetools import LRUCache
+from langchain_core.embeddings import Embeddings
+
+# SQLite's default limit on bound parameters per statement is 999
+_SQL_BATCH_SIZE = 500
+
+# Most recent query vectors kept in memory
+QUERY_CACHE_SIZE = 2048
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that consults an on-disk cache before calling the provider"""
+
+    def __init__(self, embeddings: Embeddings, db_path: str, query_cache_size: int = QUERY_CACHE_SIZE):
+        self._embeddings = embeddings
+        self._model = getattr(embeddings, "model", type(embeddings).__name__)
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._queries: LRUCache = LRUCache(maxsize=query_cache_size)
+        self._queries_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Open the cache database on first use (call with the lock held)"""
+        if self._conn is None:
+            conn = sqlite3.connect(self._db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS emb_cache (key TEXT PRIMARY KEY, vec BLOB NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _key(self, text: str) -> str:
+        """Cache key for a text under the wrapped model"""
+        normalized = unicodedata.normalize("NFC", text)
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{self._model}:{digest}"
+
+    def _fetch(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Load cached vectors for the given keys"""
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(keys), _SQL_BATCH_SIZE):
+                batch = keys[start:start + _SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vec FROM emb_cache WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def _store(self, items: Dict[str, List[float]]) -> None:
+        """Persist newly computed vectors"""
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO emb_cache (key, vec) VALUES (?, ?)",
+                [(key, np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in items.items()]
+            )
+            conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, calling the provider only for texts not already cached"""
+        keys = [self._key(text) for text in texts]
+        cached = self._fetch(list(set(keys)))
+
+        # Embed each distinct missing text once
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            vectors = self._embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed)
+            cached.update(computed)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, reusing the in-memory vector for recently repeated questions"""
+        key = self._key(text)
+        with self._queries_lock:
+            vector = self._queries.get(key)
+        if vector is not None:
+            return vector
+
+        vector = self._embeddings.embed_query(text)
+        with self._queries_lock:
+            self._queries[key] = vector
+        return vector
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -3,9 +3,10 @@ Nigerian Tax Reform Bills Document Question Answering
 Uses LangChain for document processing and LangGraph for agentic retrieval
 """
 
-from typing import List, Dict, Any, TypedDict, Annotated, cast, Optional
+from typing import List, Dict, Any, TypedDict, Annotated, cast, Optional, Iterator, Tuple
 from pathlib import Path
 from datetime import datetime
+import logging
 import re
 
 from langchain_community.document_loaders import PyPDFLoader
@@ -13,7 +14,7 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
-from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, BaseMessage
 from langchain_core.vectorstores import VectorStoreRetriever
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
@@ -24,9 +25,40 @@ from langgraph.checkpoint.memory import MemorySaver
 
 from dotenv import load_dotenv
 
+try:
+    from .embedding_cache import CachedEmbeddings
+except ImportError:  # run directly as a script
+    from embedding_cache import CachedEmbeddings
+
 # Load environment variables
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
+# Texts sent per embeddings API request when indexing (the API accepts up to 2048)
+EMBEDDING_BATCH_SIZE = 1024
+# Retries with exponential backoff on rate limits (429) and transient errors
+EMBEDDING_MAX_RETRIES = 6
+
+# Greetings and thanks that never need the statutes. Matched against the whole
+# message (lowercased, punctuation stripped) so anything with a real question
+# attached still goes through normal routing. Messages the hard gate in
+# _is_message_allowed rejects never reach routing, so bare acknowledgements
+# like "ok" aren't listed, and greetings only pass it at three words or fewer.
+SMALL_TALK_PATTERN = re.compile(
+    r"(hi|hello|hey|good (morning|afternoon|evening|day)|thanks|thank you|thank u"
+    r"|sannu|ndewo|bawo|kedu|how far|wetin dey)"
+    r"( (there|again|so much|very much|a lot|sir|ma|everyone|all))?"
+)
+
+
+class RAGEngineError(RuntimeError):
+    """Raised when the RAG engine cannot produce an answer"""
+
+
+class DocumentLoadError(RAGEngineError, ValueError):
+    """Raised when the policy documents can't be found or loaded"""
+
 
 class ConversationState(TypedDict):
     """State for the conversation agent"""
@@ -197,25 +229,39 @@ class RAGEngine:
 
 
 
-    def __init__(self, docs_path: Optional[str] = None, persist_directory: Optional[str] = None):
+    def __init__(
+        self,
+        docs_path: Optional[str] = None,
+        persist_directory: Optional[str] = None,
+        embedding_cache_path: Optional[str] = None
+    ):
         """
         Initialize the RAG engine
 
         Args:
             docs_path: Path to the documents directory
             persist_directory: Path to persist the vector database
+            embedding_cache_path: Path to the SQLite embedding cache
         """
         if docs_path is None:
             docs_path = str(Path(__file__).parent / "docs")
         if persist_directory is None:
             persist_directory = str(Path(__file__).parent / "chroma_db")
+        if embedding_cache_path is None:
+            embedding_cache_path = str(Path(__file__).parent / "embedding_cache.sqlite3")
 
         self.docs_path = docs_path
         self.persist_directory = persist_directory
 
         # Initialize LLM and embeddings
         self.llm = ChatOpenAI(model="gpt-4", temperature=0)
-        self.embeddings = OpenAIEmbeddings()
+        self.embeddings = CachedEmbeddings(
+            OpenAIEmbeddings(
+                chunk_size=EMBEDDING_BATCH_SIZE,
+                max_retries=EMBEDDING_MAX_RETRIES
+            ),
+            embedding_cache_path
+        )
 
         # Initialize vector store
         self.vectorstore = None  # type: ignore
@@ -580,18 +626,18 @@ class RAGEngine:
         docs_dir = Path(self.docs_path)
 
         if not docs_dir.exists():
-            raise ValueError(
+            raise DocumentLoadError(
                 f"Documents directory not found: {self.docs_path}")
 
         pdf_files = list(docs_dir.glob("*.pdf"))
 
         if not pdf_files:
-            raise ValueError(f"No PDF files found in {self.docs_path}")
+            raise DocumentLoadError(f"No PDF files found in {self.docs_path}")
 
-        print(f"Loading {len(pdf_files)} PDF documents...")
+        log.info("Loading %s PDF documents...", len(pdf_files))
 
         for pdf_file in pdf_files:
-            print(f"  - Loading {pdf_file.name}")
+            log.info("  - Loading %s", pdf_file.name)
             loader = PyPDFLoader(str(pdf_file))
             docs = loader.load()
 
@@ -617,7 +663,7 @@ class RAGEngine:
 
             documents.extend(docs)
 
-        print(f"Loaded {len(documents)} pages total")
+        log.info("Loaded %s pages total", len(documents))
         return documents
 
     def create_vector_database(self, force_reload: bool = False):
@@ -631,13 +677,13 @@ class RAGEngine:
 
         # Check if database exists
         if persist_path.exists() and not force_reload:
-            print("Loading existing vector database...")
+            log.info("Loading existing vector database...")
             self.vectorstore = Chroma(
                 persist_directory=self.persist_directory,
                 embedding_function=self.embeddings
             )
         else:
-            print("Creating new vector database...")
+            log.info("Creating new vector database...")
 
             # Load documents
             documents = self.load_documents()
@@ -651,7 +697,7 @@ class RAGEngine:
             )
 
             splits = text_splitter.split_documents(documents)
-            print(f"Split into {len(splits)} chunks")
+            log.info("Split into %s chunks", len(splits))
 
             # Re-extract sections for each chunk (in case split breaks section context)
             for split in splits:
@@ -661,14 +707,16 @@ class RAGEngine:
                     if extracted_section != "General Provisions":
                         split.metadata["section"] = extracted_section
 
-            # Create vector store
+            # Create vector store. All chunk texts go to a single
+            # embed_documents call, which sends EMBEDDING_BATCH_SIZE texts per
+            # API request instead of one request per chunk.
             self.vectorstore = Chroma.from_documents(
                 documents=splits,
                 embedding=self.embeddings,
                 persist_directory=self.persist_directory
             )
 
-            print("Vector database created and persisted")
+            log.info("Vector database created and persisted")
 
         # Create retriever
         self.retriever = self.vectorstore.as_retriever(
@@ -912,6 +960,11 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
             "detected_language": detected_language
         }
 
+    def _is_small_talk(self, message: str) -> bool:
+        """Check if a message is only a greeting, thanks or acknowledgement"""
+        normalized = " ".join(re.sub(r"[^\w\s]", " ", message.lower()).split())
+        return SMALL_TALK_PATTERN.fullmatch(normalized) is not None
+
     def _should_retrieve(self, state: ConversationState) -> str:
         """
         Agent node: Decide if retrieval is needed based on the conversation.
@@ -922,6 +975,10 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
         last_msg = messages[-1] if messages else None
         last_message = str(last_msg.content) if last_msg else ""
 
+        # Small talk is answered directly, skipping the routing LLM calls and retrieval
+        if self._is_small_talk(last_message):
+            return "generate"
+
         # FIRST: Quick keyword-based rejection for obvious non-tax questions
         if not self._is_tax_related(last_message):
             # Double-check with LLM for edge cases
@@ -1032,7 +1089,7 @@ If there is ANY doubt, answer 'NOT_TAX'."""),
         
         return "generate"
 
-    def _retrieve_documents(self, state: ConversationState) -> ConversationState:
+    def _retrieve_documents(self, state: ConversationState, config: RunnableConfig) -> ConversationState:
         """
         Agent node: Retrieve relevant documents from vector store
         Extracts dynamic citations with sections, subsections, paragraphs, and schedules
@@ -1043,9 +1100,18 @@ If there is ANY doubt, answer 'NOT_TAX'."""),
         last_message = str(last_msg.content) if last_msg else ""
 
         # Retrieve relevant documents
-        if self.retriever is None:
-            raise RuntimeError("Retriever not initialized")
-        docs = self.retriever.invoke(last_message)
+        if self.retriever is None or self.vectorstore is None:
+            raise RAGEngineError("Retriever not initialized")
+        # Reuse the caller's embedding of this message (the API's semantic
+        # cache already computed it) instead of embedding it a second time
+        configurable = config.get("configurable", {})
+        query_embedding = configurable.get("query_embedding")
+        if query_embedding is not None and configurable.get("query_text") == last_message:
+            docs = self.vectorstore.similarity_search_by_vector(
+                query_embedding, **self.retriever.search_kwargs
+            )
+        else:
+            docs = self.retriever.invoke(last_message)
 
         # Format context with dynamic source citations
         context_parts = []
@@ -1231,8 +1297,8 @@ If there is ANY doubt, answer 'NOT_TAX'."""),
             last_human_msg = next((msg.content for msg in reversed(messages) if isinstance(msg, HumanMessage)), "")
         
         # Log detected language and role for debugging
-        print(f"🌍 Detected language: {detected_language} from message: {last_human_msg[:50]}...")
-        print(f"👤 User role: {user_role}")
+        log.debug("🌍 Detected language: %s from message: %.50s...", detected_language, last_human_msg)
+        log.debug("👤 User role: %s", user_role)
 
         if context:
             # Generate answer with context and dynamic citations
@@ -1491,16 +1557,21 @@ If the context doesn't contain enough information, state what is missing and pro
 
 You are a compliance-first, statute-driven Nigerian Tax AI."""
 
+            # Retrieved context changes every turn, so it goes after the earlier
+            # conversation: the system prompt and history then form a stable
+            # prefix the provider's prompt cache can reuse across turns
             prompt = ChatPromptTemplate.from_messages([
                 ("system", system_message),
+                MessagesPlaceholder(variable_name="history"),
                 ("system", "Context from policy documents:\n\n{context}"),
                 MessagesPlaceholder(variable_name="messages"),
             ])
 
             chain = prompt | self.llm | StrOutputParser()
             response = chain.invoke({
+                "history": messages[:-1],
                 "context": context,
-                "messages": messages
+                "messages": messages[-1:]
             })
 
             # Filter out any citations in the response that aren't backed by actual sources
@@ -1773,7 +1844,7 @@ You are a compliance-first, statute-driven Nigerian Tax AI."""
         workflow.add_edge("generate", END)
         workflow.add_edge("reject", END)
         self.app = workflow.compile(checkpointer=self.memory)
-        print("Multi-agent workflow with skills built successfully")
+        log.info("Multi-agent workflow with skills built successfully")
 
     def initialize(self, force_reload: bool = False):
         """
@@ -1782,7 +1853,7 @@ You are a compliance-first, statute-driven Nigerian Tax AI."""
         Args:
             force_reload: Force reload of documents
         """
-        print("Initializing RAG Engine...")
+        log.info("Initializing RAG Engine...")
 
         # Create vector database
         self.create_vector_database(force_reload=force_reload)
@@ -1790,7 +1861,7 @@ You are a compliance-first, statute-driven Nigerian Tax AI."""
         # Build agent
         self.build_agent()
 
-        print("RAG Engine initialized and ready!")
+        log.info("RAG Engine initialized and ready!")
 
     def _get_rejection_response(self, language: str = "English") -> str:
         """Get the standard rejection response in the appropriate language."""
@@ -1898,20 +1969,23 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
         # If no tax keywords found, reject the message
         return False
 
-    def chat(self, message: str, session_id: str = "default", user_role: str = "taxpayer") -> Dict[str, Any]:
+    def _prepare_chat(
+        self, message: str, session_id: str, user_role: str, regenerate: bool = False,
+        query_embedding: Optional[List[float]] = None
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[RunnableConfig], Optional[Dict[str, Any]]]:
         """
-        Chat with the RAG agent
-
-        Args:
-            message: User message
-            session_id: Session ID for conversation tracking
-            user_role: User role (tax_lawyer, taxpayer, or company)
+        Build the agent config and input state for a new user message.
+        With regenerate, the session's last exchange is dropped first so the
+        message replaces it rather than being asked a second time.
+        A query_embedding of the message is passed to retrieval through the
+        config, which is not checkpointed.
 
         Returns:
-            Dictionary with response and metadata
+            (rejection result, None, None) for blocked messages,
+            otherwise (None, config, initial state)
         """
         if self.app is None:
-            raise RuntimeError(
+            raise RAGEngineError(
                 "Agent not initialized. Call initialize() first.")
 
         # Detect language from the user's message FIRST
@@ -1927,7 +2001,7 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
                 "sources": [],
                 "used_retrieval": False,
                 "rejected": True
-            }
+            }, None, None
         # ============================================================
 
         # Validate user_role
@@ -1938,12 +2012,26 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
         # Get existing state from checkpointer
         config: RunnableConfig = {"configurable": {
             "thread_id": session_id}}  # type: ignore
+        if query_embedding is not None:
+            config["configurable"]["query_text"] = message
+            config["configurable"]["query_embedding"] = query_embedding
 
         try:
             existing_state = self.app.get_state(config)  # type: ignore
             existing_messages = existing_state.values.get("messages", [])
         except Exception:
             existing_messages = []
+
+        if regenerate:
+            # Rewind to just before the last user turn; the prompt prefix is then
+            # identical to the original request's, so the provider cache hits
+            last_human = next(
+                (i for i in range(len(existing_messages) - 1, -1, -1)
+                 if isinstance(existing_messages[i], HumanMessage)),
+                None
+            )
+            if last_human is not None:
+                existing_messages = existing_messages[:last_human]
         
         # Append new message to existing conversation with timestamp and language
         timestamp = datetime.now().isoformat()
@@ -1963,10 +2051,39 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
             "user_role": user_role,
             "detected_language": detected_language
         }
+        return None, config, initial_state
+
+    def chat(
+        self, message: str, session_id: str = "default", user_role: str = "taxpayer", regenerate: bool = False,
+        query_embedding: Optional[List[float]] = None
+    ) -> Dict[str, Any]:
+        """
+        Chat with the RAG agent
+
+        Args:
+            message: User message
+            session_id: Session ID for conversation tracking
+            user_role: User role (tax_lawyer, taxpayer, or company)
+            regenerate: Replace the session's last exchange instead of adding a new one
+            query_embedding: Embedding of message already computed by the caller, reused for retrieval
+
+        Returns:
+            Dictionary with response and metadata
+        """
+        rejection, config, initial_state = self._prepare_chat(
+            message, session_id, user_role, regenerate, query_embedding
+        )
+        if rejection is not None:
+            return rejection
 
         # Run the agent
-        result = cast(ConversationState, self.app.invoke(
-            cast(Any, initial_state), config))  # type: ignore
+        try:
+            result = cast(ConversationState, self.app.invoke(
+                cast(Any, initial_state), config))  # type: ignore
+        except RAGEngineError:
+            raise
+        except Exception as e:
+            raise RAGEngineError(f"Error processing chat request: {e}") from e
         ai_message = result["messages"][-1]
 
         return {
@@ -1975,6 +2092,96 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
             "used_retrieval": result.get("needs_retrieval", False)
         }
 
+    def chat_stream(
+        self, message: str, session_id: str = "default", user_role: str = "taxpayer",
+        query_embedding: Optional[List[float]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Chat with the RAG agent, yielding answer tokens as the LLM generates them
+
+        Yields {"type": "delta", "content": ...} events for each token of the
+        answer, then a single {"type": "result", ...} event carrying the same
+        final response and metadata that chat() returns. The final response
+        may differ from the concatenated deltas because citations are
+        verified after generation.
+        """
+        rejection, config, initial_state = self._prepare_chat(
+            message, session_id, user_role, query_embedding=query_embedding
+        )
+        if rejection is not None:
+            yield {"type": "delta", "content": rejection["response"]}
+            yield {"type": "result", **rejection}
+            return
+
+        result: Dict[str, Any] = {}
+        try:
+            for mode, chunk in self.app.stream(  # type: ignore
+                    cast(Any, initial_state), config, stream_mode=["messages", "values"]):
+                if mode == "values":
+                    result = chunk
+                    continue
+                token, metadata = chunk
+                # Only streamed answer tokens, not routing calls or whole state messages
+                if (isinstance(token, AIMessageChunk) and token.content
+                        and metadata.get("langgraph_node") == "generate"):
+                    yield {"type": "delta", "content": token.content}
+        except RAGEngineError:
+            raise
+        except Exception as e:
+            raise RAGEngineError(f"Error processing chat request: {e}") from e
+
+        ai_message = result["messages"][-1]
+        yield {
+            "type": "result",
+            "response": ai_message.content,
+            "sources": result.get("sources", []),
+            "used_retrieval": result.get("needs_retrieval", False)
+        }
+
+    def record_exchange(self, message: str, response: str, session_id: str = "default"):
+        """
+        Append a user message and an already-known AI response to a session's
+        conversation memory without running the agent (e.g. for cached answers)
+
+        Args:
+            message: User message
+            response: AI response to record
+            session_id: Session ID for conversation tracking
+        """
+        if self.app is None:
+            raise RAGEngineError(
+                "Agent not initialized. Call initialize() first.")
+
+        config: RunnableConfig = {"configurable": {
+            "thread_id": session_id}}  # type: ignore
+
+        try:
+            existing_state = self.app.get_state(config)  # type: ignore
+            existing_messages = existing_state.values.get("messages", [])
+        except Exception:
+            existing_messages = []
+
+        detected_language = self._detect_language(message)
+        timestamp = datetime.now().isoformat()
+        human_msg = HumanMessage(content=message)
+        human_msg.additional_kwargs = {
+            "timestamp": timestamp,
+            "language": detected_language
+        }
+        ai_msg = AIMessage(content=response)
+        ai_msg.additional_kwargs = {
+            "timestamp": timestamp,
+            "language": detected_language
+        }
+
+        # Record as the "generate" node so the thread ends up where a normal
+        # agent run would leave it
+        self.app.update_state(  # type: ignore
+            config,
+            {"messages": existing_messages + [human_msg, ai_msg]},
+            as_node="generate"
+        )
+
     def get_conversation_history(self, session_id: str = "default") -> List[Dict[str, str]]:
         """
         Get conversation history for a session
@@ -2054,7 +2261,7 @@ Kedu ka m ga-esi nyere gị aka na okwu ụtụ isi Naịjirịa taa?"""
                 return "New Conversation"
 
             # Log the message being analyzed
-            print(f"🏷️ Title generation - Analyzing message: {first_user_msg[:80]}...")
+            log.debug("🏷️ Title generation - Analyzing message: %.80s...", first_user_msg)
 
             # Use LLM to detect language AND generate title in one call
             # This is more accurate than rule-based detection
@@ -2085,7 +2292,7 @@ INSTRUCTIONS:
             title = self.llm.invoke(title_prompt).content
             
             # Log the generated title
-            print(f"🏷️ Generated title: {title}")
+            log.info("🏷️ Generated title: %s", title)
 
             # Clean and truncate title
             if isinstance(title, str):
@@ -2100,12 +2307,13 @@ INSTRUCTIONS:
                 return "New Conversation"
 
         except Exception as e:
-            print(f"❌ Error generating title: {e}")
+            log.error("❌ Error generating title: %s", e)
             return "New Conversation"
 
 
 if __name__ == "__main__":
     # Example usage
+    logging.basicConfig(level=logging.INFO)
     rag = RAGEngine()
     rag.initialize(force_reload=False)
     # Test the agent
@@ -0,0 +1,47 @@
+"""
+Exact-match response cache for the chat endpoint
+Answers are keyed by the normalized user message and user role
+"""
+
+import hashlib
+import threading
+from typing import Optional, Dict, Any
+
+from cachetools import TTLCache
+
+
+class SmartResponseCache:
+    """Thread-safe LRU cache of RAG answers with a per-entry TTL"""
+
+    def __init__(self, maxsize: int = 2048, ttl: int = 3600):
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(message: str, user_role: str) -> str:
+        """Build a cache key from the normalized message and user role"""
+        normalized = " ".join(message.strip().lower().split())
+        return hashlib.sha256(f"{normalized}|{user_role}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached result for a key, or None on a miss"""
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key: str, result: Dict[str, Any]) -> None:
+        """Cache the response, sources and retrieval flag of a RAG result"""
+        with self._lock:
+            self._cache[key] = {
+                "response": result["response"],
+                "sources": result.get("sources", []),
+                "used_retrieval": result.get("used_retrieval", False)
+            }
+
+    def clear(self) -> None:
+        """Drop every cached answer (e.g. after the documents are reloaded)"""
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._cache)
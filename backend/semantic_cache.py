@@ -0,0 +1,114 @@
+"""
+Semantic response cache for the chat endpoint
+Catches paraphrased questions ("what is VAT?" vs "explain VAT") that the
+exact-match cache misses, using random-projection LSH over query embeddings
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Dict, Any, List, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Thread-safe LRU cache of RAG answers looked up by embedding similarity
+
+    Each embedding is hashed into several LSH tables by the signs of its
+    projections onto random Gaussian hyperplanes. A lookup only compares the
+    query against entries that share a bucket in at least one table, then
+    confirms a hit with an exact cosine-similarity check.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[str], List[float]],
+        threshold: float = 0.95,
+        num_tables: int = 8,
+        bits_per_table: int = 8,
+        maxsize: int = 10_000,
+        seed: int = 0
+    ):
+        self._embed_fn = embed_fn
+        self._threshold = threshold
+        self._num_tables = num_tables
+        self._bits_per_table = bits_per_table
+        self._maxsize = maxsize
+        self._rng = np.random.default_rng(seed)
+        self._planes: Optional[np.ndarray] = None
+        self._bit_weights = 1 << np.arange(bits_per_table, dtype=np.int64)
+
+        self._next_id = 0
+        # entry id -> (user_role, unit embedding, cached result, bucket keys)
+        self._entries: "OrderedDict[int, Tuple[str, np.ndarray, Dict[str, Any], List[tuple]]]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = {}
+        self._lock = threading.RLock()
+
+    def embed(self, message: str) -> np.ndarray:
+        """Embed and L2-normalize a message"""
+        vector = np.asarray(self._embed_fn(message), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _bucket_keys(self, user_role: str, vector: np.ndarray) -> List[tuple]:
+        """LSH bucket key of a unit embedding in every table"""
+        if self._planes is None:
+            # Sized lazily from the first embedding seen
+            self._planes = self._rng.standard_normal(
+                (self._num_tables * self._bits_per_table, vector.shape[0])
+            ).astype(np.float32)
+        bits = (self._planes @ vector > 0).reshape(self._num_tables, self._bits_per_table)
+        signatures = bits @ self._bit_weights
+        return [(user_role, table, int(signature)) for table, signature in enumerate(signatures)]
+
+    def lookup(self, vector: np.ndarray, user_role: str) -> Optional[Dict[str, Any]]:
+        """Return the cached result of the most similar stored query, or None"""
+        with self._lock:
+            candidates = set()
+            for key in self._bucket_keys(user_role, vector):
+                candidates.update(self._buckets.get(key, ()))
+
+            best_id, best_score = None, self._threshold
+            for entry_id in candidates:
+                score = float(self._entries[entry_id][1] @ vector)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def store(self, vector: np.ndarray, user_role: str, result: Dict[str, Any]) -> None:
+        """Cache the response, sources and retrieval flag of a RAG result"""
+        with self._lock:
+            keys = self._bucket_keys(user_role, vector)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (user_role, vector, {
+                "response": result["response"],
+                "sources": result.get("sources", []),
+                "used_retrieval": result.get("used_retrieval", False)
+            }, keys)
+            for key in keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+
+            while len(self._entries) > self._maxsize:
+                old_id, (_, _, _, old_keys) = self._entries.popitem(last=False)
+                for key in old_keys:
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.discard(old_id)
+                        if not bucket:
+                            del self._buckets[key]
+
+    def clear(self) -> None:
+        """Drop every cached answer (e.g. after the documents are reloaded)"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
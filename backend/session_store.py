@@ -0,0 +1,474 @@
+"""
+Session metadata and feedback storage for the API
+Uses Redis when REDIS_URL is set so every uvicorn worker shares the same
+state; otherwise falls back to per-process in-memory dictionaries
+"""
+
+import os
+import json
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Iterable
+
+# Session hashes expire after a day of inactivity
+SESSION_TTL_SECONDS = 86400
+
+# Redis feedback hashes expire this long after a session's last rating
+FEEDBACK_TTL_SECONDS = int(os.getenv("FEEDBACK_TTL_SECONDS", str(30 * 86400)))
+
+# Most sessions one worker keeps in memory before evicting the least recently used
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+
+# Most sessions with feedback one worker keeps in memory
+MAX_FEEDBACK_SESSIONS = int(os.getenv("MAX_FEEDBACK_SESSIONS", "10000"))
+
+# Session fields stored as integers (Redis hands every hash field back as a string)
+_INT_FIELDS = frozenset({"message_count", "guest_prompt_count", "user_prompt_count"})
+
+
+class SessionNotFound(LookupError):
+    """Raised when a session id is not in the store"""
+
+
+class Session:
+    """Metadata for one chat session"""
+
+    __slots__ = (
+        "session_id", "owner_id", "created_at", "last_activity", "title",
+        "message_count", "guest_prompt_count", "user_prompt_count", "last_user_message"
+    )
+
+    def __init__(
+        self,
+        session_id: str,
+        owner_id: Optional[str] = None,
+        created_at: Optional[str] = None,
+        last_activity: Optional[str] = None,
+        title: str = "New Conversation",
+        message_count: int = 0,
+        guest_prompt_count: int = 0,
+        user_prompt_count: int = 0,
+        last_user_message: Optional[str] = None
+    ):
+        self.session_id = session_id
+        self.owner_id = owner_id  # Track who owns this session
+        self.created_at = created_at
+        self.last_activity = last_activity
+        self.title = title
+        self.message_count = message_count
+        self.guest_prompt_count = guest_prompt_count
+        self.user_prompt_count = user_prompt_count
+        # Lets /regenerate skip loading the conversation history
+        self.last_user_message = last_user_message
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+# =============================================
+# IN-MEMORY BACKEND
+# =============================================
+
+class InMemorySessionStore:
+    """
+    Session metadata kept in this process's memory, bounded by LRU eviction
+    and expired after SESSION_TTL_SECONDS without use, like the Redis keys
+    """
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS, ttl_seconds: float = SESSION_TTL_SECONDS):
+        self._max_sessions = max_sessions
+        self._ttl = ttl_seconds
+        # Least recently used first
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        # Monotonic time each session was last used
+        self._last_used: Dict[str, float] = {}
+        # Track which sessions belong to which user (for fast lookup)
+        self._user_sessions: Dict[str, set] = {}
+
+    def _expired(self, session_id: str, now: float) -> bool:
+        return now - self._last_used[session_id] > self._ttl
+
+    def _drop(self, session_id: str) -> Optional[Session]:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            del self._last_used[session_id]
+            self._forget_owner(session)
+        return session
+
+    def _touch(self, session_id: str) -> Optional[Session]:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if self._expired(session_id, now):
+            self._drop(session_id)
+            return None
+        self._sessions.move_to_end(session_id)
+        self._last_used[session_id] = now
+        return session
+
+    def _evict(self) -> None:
+        """Drop expired sessions, then the least recently used ones while over capacity"""
+        now = time.monotonic()
+        # Recency order means expired sessions are all at the front
+        while self._sessions:
+            oldest = next(iter(self._sessions))
+            if not self._expired(oldest, now) and len(self._sessions) <= self._max_sessions:
+                break
+            self._drop(oldest)
+
+    def _forget_owner(self, session: Session) -> None:
+        owned = self._user_sessions.get(session.owner_id)
+        if owned is not None:
+            owned.discard(session.session_id)
+            if not owned:
+                del self._user_sessions[session.owner_id]
+
+    async def get(self, session_id: str) -> Optional[Session]:
+        """Get a session's metadata (treat the result as read-only)"""
+        return self._touch(session_id)
+
+    async def get_many(self, session_ids: Iterable[str]) -> Dict[str, Session]:
+        """Get metadata for several sessions, skipping unknown or expired ids"""
+        now = time.monotonic()
+        return {
+            sid: self._sessions[sid] for sid in session_ids
+            if sid in self._sessions and not self._expired(sid, now)
+        }
+
+    async def create(self, session: Session) -> None:
+        """Store a new session, evicting the least recently used ones if full"""
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        self._last_used[session.session_id] = time.monotonic()
+        if session.owner_id:
+            self._user_sessions.setdefault(session.owner_id, set()).add(session.session_id)
+        self._evict()
+
+    async def update(self, session_id: str, **fields: Any) -> None:
+        """Set fields on an existing session"""
+        session = self._touch(session_id)
+        if session is not None:
+            for field, value in fields.items():
+                setattr(session, field, value)
+
+    async def incr(self, session_id: str, field: str, amount: int = 1) -> int:
+        """Increment a counter field and return its new value"""
+        session = self._touch(session_id)
+        if session is None:
+            # Evicted or expired since the caller looked it up
+            raise SessionNotFound(session_id)
+        value = getattr(session, field) + amount
+        setattr(session, field, value)
+        return value
+
+    async def delete(self, session_id: str) -> bool:
+        """Remove a session. Returns False if it did not exist."""
+        return self._drop(session_id) is not None
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryFeedbackStore:
+    """Feedback entries kept in this process's memory, bounded by LRU eviction of sessions"""
+
+    def __init__(self, max_sessions: int = MAX_FEEDBACK_SESSIONS):
+        self._max_sessions = max_sessions
+        # session_id -> {message_index: entry}, least recently updated session first
+        self._feedback: "OrderedDict[str, Dict[int, Dict[str, Any]]]" = OrderedDict()
+        # Running totals per feedback type, so stats never walk the entries
+        self._counts: Dict[str, int] = {"liked": 0, "disliked": 0}
+
+    def _count(self, entries: Iterable[Dict[str, Any]], delta: int) -> None:
+        for f in entries:
+            self._counts[f["feedback_type"]] = self._counts.get(f["feedback_type"], 0) + delta
+
+    async def put(self, entry: Dict[str, Any]) -> None:
+        """Add feedback for a message, replacing any earlier feedback on it"""
+        session_id = entry["session_id"]
+        session_feedback = self._feedback.setdefault(session_id, {})
+        self._feedback.move_to_end(session_id)
+        while len(self._feedback) > self._max_sessions:
+            _, evicted = self._feedback.popitem(last=False)
+            self._count(evicted.values(), -1)
+
+        previous = session_feedback.get(entry["message_index"])
+        if previous is not None:
+            self._count([previous], -1)
+        session_feedback[entry["message_index"]] = entry
+        self._count([entry], 1)
+
+    async def get(self, session_id: str) -> Optional[List[Dict[str, Any]]]:
+        """All feedback for a session, or None if it has none"""
+        session_feedback = self._feedback.get(session_id)
+        return list(session_feedback.values()) if session_feedback is not None else None
+
+    async def remove(self, session_id: str, message_index: int) -> Optional[bool]:
+        """
+        Remove feedback for a message. Returns None if the session has no
+        feedback and False if the message has none.
+        """
+        if session_id not in self._feedback:
+            return None
+        session_feedback = self._feedback[session_id]
+        removed = session_feedback.pop(message_index, None)
+        if removed is None:
+            return False
+        self._count([removed], -1)
+        if not session_feedback:
+            del self._feedback[session_id]
+        return True
+
+    async def stats(self) -> Dict[str, int]:
+        """Liked/disliked totals and the number of sessions with feedback"""
+        return {
+            "liked": self._counts["liked"],
+            "disliked": self._counts["disliked"],
+            "sessions": len(self._feedback)
+        }
+
+    async def close(self) -> None:
+        pass
+
+
+# =============================================
+# REDIS BACKEND
+# =============================================
+
+def _session_key(session_id: str) -> str:
+    return f"sess:{session_id}"
+
+
+def _user_sessions_key(user_id: str) -> str:
+    return f"user_sess:{user_id}"
+
+
+def _feedback_key(session_id: str) -> str:
+    return f"fb:{session_id}"
+
+
+_FEEDBACK_STATS_KEY = "fb:stats"
+# Sorted set of session ids with feedback, scored by when their hash expires
+_FEEDBACK_SESSIONS_KEY = "fb:session_expiry"
+
+# HINCRBY alone would recreate an expired session as an ownerless hash holding
+# only the counter, so the increment only runs if the hash still exists.
+# Active sessions also keep their owner's index set alive.
+_INCR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local value = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+local owner = redis.call('HGET', KEYS[1], 'owner_id')
+if owner then
+    redis.call('EXPIRE', ARGV[4] .. owner, ARGV[3])
+end
+return value
+"""
+
+# Read-modify-write of a rating and the running totals, atomic so concurrent
+# re-rates of one message can't both subtract the same previous rating
+_FEEDBACK_PUT_SCRIPT = """
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if previous then
+    redis.call('HINCRBY', KEYS[2], cjson.decode(previous)['feedback_type'], -1)
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('HINCRBY', KEYS[2], ARGV[3], 1)
+redis.call('ZADD', KEYS[3], ARGV[5], ARGV[6])
+"""
+
+# Returns -1 if the session has no feedback, 0 if the message has none, 1 if removed
+_FEEDBACK_REMOVE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if not previous then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HINCRBY', KEYS[2], cjson.decode(previous)['feedback_type'], -1)
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[3], ARGV[2])
+end
+return 1
+"""
+
+
+def _decode_session(session_id: str, raw: Dict[str, str]) -> Optional[Session]:
+    """Convert a Redis session hash back to a Session"""
+    if not raw:
+        return None
+    fields = {
+        field: int(value) if field in _INT_FIELDS else value
+        for field, value in raw.items()
+        if field in Session.__slots__
+    }
+    fields["session_id"] = session_id
+    return Session(**fields)
+
+
+class RedisSessionStore:
+    """Session metadata kept in Redis hashes shared by all workers"""
+
+    def __init__(self, client):
+        self._redis = client
+        self._incr = client.register_script(_INCR_SCRIPT)
+
+    async def get(self, session_id: str) -> Optional[Session]:
+        """Get a session's metadata"""
+        return _decode_session(session_id, await self._redis.hgetall(_session_key(session_id)))
+
+    async def get_many(self, session_ids: Iterable[str]) -> Dict[str, Session]:
+        """Get metadata for several sessions in one round-trip, skipping unknown ids"""
+        session_ids = list(session_ids)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for sid in session_ids:
+                pipe.hgetall(_session_key(sid))
+            results = await pipe.execute()
+        return {
+            sid: decoded
+            for sid, raw in zip(session_ids, results)
+            if (decoded := _decode_session(sid, raw)) is not None
+        }
+
+    async def create(self, session: Session) -> None:
+        """Store a new session"""
+        key = _session_key(session.session_id)
+        # Redis hashes can't hold None, so absent fields read back as defaults
+        mapping = {
+            field: value for field, value in session.to_dict().items()
+            if value is not None and field != "session_id"
+        }
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, SESSION_TTL_SECONDS)
+            if session.owner_id:
+                owner_key = _user_sessions_key(session.owner_id)
+                pipe.sadd(owner_key, session.session_id)
+                pipe.expire(owner_key, SESSION_TTL_SECONDS)
+            await pipe.execute()
+
+    async def update(self, session_id: str, **fields: Any) -> None:
+        """Set fields on an existing session"""
+        key = _session_key(session_id)
+        mapping = {field: value for field, value in fields.items() if value is not None}
+        if not mapping:
+            return
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, SESSION_TTL_SECONDS)
+            await pipe.execute()
+
+    async def incr(self, session_id: str, field: str, amount: int = 1) -> int:
+        """Atomically increment a counter field and return its new value"""
+        value = await self._incr(
+            keys=[_session_key(session_id)],
+            args=[field, amount, SESSION_TTL_SECONDS, _user_sessions_key("")]
+        )
+        if value is None:
+            # Expired since the caller looked it up
+            raise SessionNotFound(session_id)
+        return int(value)
+
+    async def delete(self, session_id: str) -> bool:
+        """Remove a session. Returns False if it did not exist."""
+        key = _session_key(session_id)
+        owner_id = await self._redis.hget(key, "owner_id")
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            if owner_id:
+                pipe.srem(_user_sessions_key(owner_id), session_id)
+            deleted = (await pipe.execute())[0]
+        return bool(deleted)
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+class RedisFeedbackStore:
+    """
+    Feedback entries kept in Redis, one hash per session keyed by message index.
+    Hashes expire FEEDBACK_TTL_SECONDS after their last rating; the liked and
+    disliked totals are running counts and keep ratings whose hash expired.
+    """
+
+    def __init__(self, client):
+        self._redis = client
+        self._put = client.register_script(_FEEDBACK_PUT_SCRIPT)
+        self._remove = client.register_script(_FEEDBACK_REMOVE_SCRIPT)
+
+    async def put(self, entry: Dict[str, Any]) -> None:
+        """Add feedback for a message, replacing any earlier feedback on it"""
+        session_id = entry["session_id"]
+        await self._put(
+            keys=[_feedback_key(session_id), _FEEDBACK_STATS_KEY, _FEEDBACK_SESSIONS_KEY],
+            args=[
+                str(entry["message_index"]), json.dumps(entry), entry["feedback_type"],
+                FEEDBACK_TTL_SECONDS, int(time.time()) + FEEDBACK_TTL_SECONDS, session_id
+            ]
+        )
+
+    async def get(self, session_id: str) -> Optional[List[Dict[str, Any]]]:
+        """All feedback for a session, or None if it has none"""
+        raw = await self._redis.hvals(_feedback_key(session_id))
+        if not raw:
+            return None
+        entries = [json.loads(value) for value in raw]
+        entries.sort(key=lambda f: f["message_index"])
+        return entries
+
+    async def remove(self, session_id: str, message_index: int) -> Optional[bool]:
+        """
+        Remove feedback for a message. Returns None if the session has no
+        feedback and False if the message has none.
+        """
+        removed = await self._remove(
+            keys=[_feedback_key(session_id), _FEEDBACK_STATS_KEY, _FEEDBACK_SESSIONS_KEY],
+            args=[str(message_index), session_id]
+        )
+        if removed == -1:
+            return None
+        return removed == 1
+
+    async def stats(self) -> Dict[str, int]:
+        """Liked/disliked totals and the number of sessions with feedback"""
+        async with self._redis.pipeline(transaction=True) as pipe:
+            # Drop sessions whose feedback hash has expired before counting
+            pipe.zremrangebyscore(_FEEDBACK_SESSIONS_KEY, "-inf", int(time.time()))
+            pipe.hgetall(_FEEDBACK_STATS_KEY)
+            pipe.zcard(_FEEDBACK_SESSIONS_KEY)
+            _, counters, session_count = await pipe.execute()
+        return {
+            "liked": int(counters.get("liked", 0)),
+            "disliked": int(counters.get("disliked", 0)),
+            "sessions": int(session_count)
+        }
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+# =============================================
+# FACTORY
+# =============================================
+
+def create_stores(redis_url: Optional[str] = None):
+    """
+    Build the session and feedback stores.
+    Uses Redis if a URL is given (or REDIS_URL is set), otherwise in-memory dicts.
+    Configure Redis with `maxmemory` and `maxmemory-policy allkeys-lru` so
+    old sessions are evicted instead of exhausting memory.
+    """
+    redis_url = redis_url or os.getenv("REDIS_URL", "")
+    if not redis_url:
+        return InMemorySessionStore(), InMemoryFeedbackStore()
+
+    import redis.asyncio as redis
+
+    client = redis.from_url(redis_url, decode_responses=True)
+    return RedisSessionStore(client), RedisFeedbackStore(client)
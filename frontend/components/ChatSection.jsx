@@ -31,7 +31,7 @@ export const ChatSection = ({ currentChat, error, isLoading, onRegenerate, sessi
           usedRetrieval={m.used_retrieval}
         />
       ))}
-      {isLoading && (
+      {isLoading && !currentChat?.[currentChat.length - 1]?.streaming && (
         <div className="flex items-center justify-center py-4">
           <Loader2 className="animate-spin w-6 h-6 text-emerald-600" />
           <span className="ml-2 text-emerald-600 font-semibold text-xs">Thinking...</span>
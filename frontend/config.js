@@ -18,6 +18,7 @@ export default {
   API_BASE_URL,
   endpoints: {
     chat: `${API_BASE_URL}/chat`,
+    chatStream: `${API_BASE_URL}/chat/stream`,
     tts: `${API_BASE_URL}/tts`,
     sessions: `${API_BASE_URL}/sessions`,
     health: `${API_BASE_URL}/health`,
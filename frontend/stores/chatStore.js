@@ -10,6 +10,31 @@ import { persist, createJSONStorage } from 'zustand/middleware';
 import config from '../config.js';
 import { getRoleGreeting } from '../utils.js';
 
+// Read a /chat/stream Server-Sent Events body, calling onDelta for each text
+// chunk, and resolve with the final "done" event
+const readChatStream = async (res, onDelta) => {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    const frames = buffer.split('\n\n');
+    buffer = frames.pop();
+    for (const frame of frames) {
+      if (!frame.startsWith('data: ')) continue;
+      const event = JSON.parse(frame.slice(6));
+      if (event.error) throw new Error(event.error);
+      if (event.done) return event;
+      if (event.delta) onDelta(event.delta);
+    }
+  }
+  throw new Error('Chat stream ended before the response was complete');
+};
+
 // Create a custom storage that only persists for authenticated users
 const createAuthAwareStorage = () => ({
   getItem: (name) => {
@@ -144,6 +169,18 @@ export const useChatStore = create(
         }));
       },
 
+      // Merge fields into the last message (used while a response streams in)
+      patchLastMessage: (patch) => {
+        set((state) => {
+          const newChat = [...state.currentChat];
+          const last = newChat[newChat.length - 1];
+          if (last) {
+            newChat[newChat.length - 1] = { ...last, ...patch };
+          }
+          return { currentChat: newChat };
+        });
+      },
+
       // Update last assistant message (for regeneration with versions)
       updateLastAssistantMessage: (newContent, timestamp, sources) => {
         set((state) => {
@@ -215,7 +252,7 @@ export const useChatStore = create(
             headers['Authorization'] = `Bearer ${token}`;
           }
 
-          const res = await fetch(config.endpoints.chat, {
+          const res = await fetch(config.endpoints.chatStream, {
             method: 'POST',
             headers,
             body: JSON.stringify(payload),
@@ -225,21 +262,35 @@ export const useChatStore = create(
             throw new Error(await res.text() || 'Chat request failed');
           }
 
-          const data = await res.json();
+          // Show the answer as it is generated; the final event carries the
+          // verified response, sources and session details
+          const data = await readChatStream(res, (delta) => {
+            const last = get().currentChat[get().currentChat.length - 1];
+            if (last?.streaming) {
+              get().patchLastMessage({ content: last.content + delta });
+            } else {
+              get().addMessage({ role: 'assistant', content: delta, streaming: true });
+            }
+          });
 
           // Update active chat ID if new session created
           if (data.session_id && data.session_id !== activeChatId) {
             set({ activeChatId: data.session_id });
           }
 
-          // Add assistant response
-          get().addMessage({
+          const answer = {
             role: 'assistant',
             content: data.response,
             timestamp: data.timestamp,
             sources: data.sources || [],
-            used_retrieval: data.used_retrieval || false
-          });
+            used_retrieval: data.used_retrieval || false,
+            streaming: false
+          };
+          if (get().currentChat[get().currentChat.length - 1]?.streaming) {
+            get().patchLastMessage(answer);
+          } else {
+            get().addMessage(answer);
+          }
 
           // Refresh conversations for authenticated users
           if (token) {
@@ -248,7 +299,11 @@ export const useChatStore = create(
 
           return data;
         } catch (err) {
-          set({ error: 'Failed to get response. Please try again.' });
+          // Drop a half-streamed answer rather than leave it looking complete
+          set((state) => ({
+            currentChat: state.currentChat.filter((m) => !m.streaming),
+            error: 'Failed to get response. Please try again.'
+          }));
           console.error(err);
           throw err;
         } finally {
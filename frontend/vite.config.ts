@@ -6,6 +6,9 @@ import tailwindcss from '@tailwindcss/vite';
 export default defineConfig(({ mode }) => {
     const env = loadEnv(mode, '.', '');
     return {
+      // Set VITE_BASE (e.g. /static/) when the backend serves the build
+      // under FRONTEND_BASE_PATH; the default suits hosting at the site root
+      base: env.VITE_BASE || '/',
       server: {
         port: 3000,
         host: '0.0.0.0',